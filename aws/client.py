@@ -1,85 +1,185 @@
 import boto3
+import botocore.session
 import os
+import threading
+from botocore.config import Config
+from botocore.credentials import CredentialProvider, CredentialResolver, RefreshableCredentials
 from datetime import datetime, timedelta
 import pytz
+from django.conf import settings
+from django.utils.functional import SimpleLazyObject
+from .s3_presigner import S3Presigner
+
+class AssumedRoleCredentials:
+    """
+    Refreshable credentials for one IAM role.
+
+    botocore refreshes them in place when they get close to expiring, so
+    clients built on them keep their connection pools. ``prefetch`` assumes
+    the role ahead of time (from the background thread); when botocore asks
+    for a refresh it gets the prefetched credentials without calling STS on
+    the request thread.
+    """
+    # botocore starts refreshing 15 minutes before expiry, prefetch earlier
+    prefetch_ahead = timedelta(minutes=20)
+    # Credentials this close to expiry are refreshed again by botocore
+    refresh_window = timedelta(minutes=15)
+
+    def __init__(self, sts_client, role_arn, session_name):
+        self.sts_client = sts_client
+        self.role_arn = role_arn
+        self.session_name = session_name
+        self.expiration = None
+        self._prefetched = None
+        self._lock = threading.Lock()
+        self.credentials = RefreshableCredentials.create_from_metadata(
+            metadata=self._fetch(),
+            refresh_using=self._fetch,
+            method='sts-assume-role'
+        )
+
+    def _assume_role(self):
+        response = self.sts_client.assume_role(
+            RoleArn=self.role_arn,
+            RoleSessionName=self.session_name
+        )
+        credentials = response['Credentials']
+        return {
+            'access_key': credentials['AccessKeyId'],
+            'secret_key': credentials['SecretAccessKey'],
+            'token': credentials['SessionToken'],
+            'expiry_time': credentials['Expiration'].isoformat(),
+        }
+
+    def _fetch(self):
+        # Called by botocore while holding its refresh lock
+        with self._lock:
+            metadata, self._prefetched = self._prefetched, None
+
+        # Prefetched long ago, e.g. by an idle worker: botocore would reject them
+        if metadata is not None and self._expires_soon(metadata, self.refresh_window):
+            metadata = None
+
+        if metadata is None:
+            try:
+                metadata = self._assume_role()
+            except Exception as e:
+                print(f"Failed to assume role {self.role_arn}: {str(e)}")
+                raise
+
+        self.expiration = datetime.fromisoformat(metadata['expiry_time'])
+        return metadata
+
+    def _expires_soon(self, metadata, ahead):
+        return datetime.now(pytz.utc) + ahead >= datetime.fromisoformat(metadata['expiry_time'])
+
+    def needs_prefetch(self):
+        with self._lock:
+            prefetched = self._prefetched
+        # Prefetched credentials age too when botocore does not use them
+        if prefetched is not None:
+            return self._expires_soon(prefetched, self.prefetch_ahead)
+        return datetime.now(pytz.utc) + self.prefetch_ahead >= self.expiration
+
+    def prefetch(self):
+        metadata = self._assume_role()
+        with self._lock:
+            self._prefetched = metadata
+
+class _FixedCredentialProvider(CredentialProvider):
+    METHOD = 'sts-assume-role'
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+
+    def load(self):
+        return self.credentials
 
 class AWSClientManager:
-    def __init__(self, s3_role_arn, s3_session_name, sqs_role_arn, sqs_session_name, region_name):
-        self.s3_role_arn = s3_role_arn
-        self.s3_session_name = s3_session_name
-        self.sqs_role_arn = sqs_role_arn
-        self.sqs_session_name = sqs_session_name
+    """
+    Owns the S3 and SQS clients used by the API.
+
+    Each client is created once on top of refreshable credentials for its
+    IAM role and shared by every thread, so its HTTP connection pool
+    survives credential refreshes. A single daemon thread assumes the roles
+    again ahead of expiry, so request threads never wait on STS.
+    """
+    # How often the background thread checks whether credentials need prefetching
+    refresh_check_interval = 30
+
+    def __init__(self, s3_role_arn, s3_session_name, sqs_role_arn, sqs_session_name, region_name, bucket_name, max_pool_connections=10):
         self.region_name = region_name
-        self.s3_credentials = None
-        self.s3_expiration = None
-        self.sqs_credentials = None
-        self.sqs_expiration = None
-        self.s3_client = None
-        self.sqs_client = None
+        self.bucket_name = bucket_name
+        self.client_config = Config(max_pool_connections=max_pool_connections)
 
         # Initialize STS client
         self.sts_client = boto3.client('sts', region_name=self.region_name)
 
-        # Initial credential refresh
-        self.refresh_s3_credentials()
-        self.refresh_sqs_credentials()
+        self.s3_role = AssumedRoleCredentials(self.sts_client, s3_role_arn, s3_session_name)
+        self.sqs_role = AssumedRoleCredentials(self.sts_client, sqs_role_arn, sqs_session_name)
 
-    def refresh_s3_credentials(self):
-        try:
-            response = self.sts_client.assume_role(
-                RoleArn=self.s3_role_arn,
-                RoleSessionName=self.s3_session_name
-            )
-            self.s3_credentials = response['Credentials']
-            self.s3_expiration = self.s3_credentials['Expiration']
-
-            self.s3_client = boto3.client(
-                's3',
-                aws_access_key_id=self.s3_credentials['AccessKeyId'],
-                aws_secret_access_key=self.s3_credentials['SecretAccessKey'],
-                aws_session_token=self.s3_credentials['SessionToken'],
-                region_name=self.region_name
-            )
-        except Exception as e:
-            print(f"Failed to refresh S3 credentials: {str(e)}")
-            raise
+        self.s3_client = self._create_client(
+            's3', self.s3_role, self.client_config.merge(Config(signature_version='s3v4'))
+        )
+        self.sqs_client = self._create_client('sqs', self.sqs_role, self.client_config)
+        self.s3_presigner = S3Presigner(self.s3_client, self.bucket_name, self.s3_role.credentials)
 
-    def refresh_sqs_credentials(self):
-        try:
-            response = self.sts_client.assume_role(
-                RoleArn=self.sqs_role_arn,
-                RoleSessionName=self.sqs_session_name
-            )
-            self.sqs_credentials = response['Credentials']
-            self.sqs_expiration = self.sqs_credentials['Expiration']
-
-            self.sqs_client = boto3.client(
-                'sqs',
-                aws_access_key_id=self.sqs_credentials['AccessKeyId'],
-                aws_secret_access_key=self.sqs_credentials['SecretAccessKey'],
-                aws_session_token=self.sqs_credentials['SessionToken'],
-                region_name=self.region_name
-            )
-        except Exception as e:
-            print(f"Failed to refresh SQS credentials: {str(e)}")
-            raise
+        self._refresher = None
+        self._stop_refresher = threading.Event()
+        self.start_refresher()
 
-    def is_s3_credentials_expired(self):
-        now = datetime.now(pytz.utc)
-        return now + timedelta(minutes=5) >= self.s3_expiration
+        # Threads do not survive a fork, start a new refresher in the child
+        os.register_at_fork(after_in_child=self.start_refresher)
 
-    def is_sqs_credentials_expired(self):
-        now = datetime.now(pytz.utc)
-        return now + timedelta(minutes=5) >= self.sqs_expiration
+    def _create_client(self, service_name, role, config):
+        session = botocore.session.get_session()
+        session.register_component(
+            'credential_provider',
+            CredentialResolver([_FixedCredentialProvider(role.credentials)])
+        )
+        return boto3.session.Session(botocore_session=session).client(
+            service_name,
+            region_name=self.region_name,
+            config=config
+        )
+
+    def start_refresher(self):
+        self._stop_refresher.clear()
+        self._refresher = threading.Thread(
+            target=self._refresh_loop,
+            name='aws-credentials-refresher',
+            daemon=True
+        )
+        self._refresher.start()
+
+    def stop_refresher(self):
+        self._stop_refresher.set()
+
+    def _refresh_loop(self):
+        while not self._stop_refresher.wait(self.refresh_check_interval):
+            for role in (self.s3_role, self.sqs_role):
+                try:
+                    if role.needs_prefetch():
+                        role.prefetch()
+                except Exception as e:
+                    # botocore will assume the role itself when it has to
+                    print(f"Failed to prefetch credentials for {role.role_arn}: {str(e)}")
+
+    @property
+    def s3_expiration(self):
+        return self.s3_role.expiration
+
+    @property
+    def sqs_expiration(self):
+        return self.sqs_role.expiration
 
     def get_s3_client(self):
-        if self.is_s3_credentials_expired():
-            self.refresh_s3_credentials()
         return self.s3_client
 
+    def get_s3_presigner(self):
+        return self.s3_presigner
+
     def get_sqs_client(self):
-        if self.is_sqs_credentials_expired():
-            self.refresh_sqs_credentials()
         return self.sqs_client
 
     def send_sqs_message(self, queue_url, message_body, message_attributes=None):
@@ -95,15 +195,28 @@ class AWSClientManager:
             print(f"Failed to send SQS message: {str(e)}")
             raise
 
-# Load environment variables
-account_id = os.getenv('AWS_ACCOUNT_ID')
-region_name = os.getenv('AWS_REGION')
-s3_role_arn = f'arn:aws:iam::{account_id}:role/S3AccessRole'
-s3_session_name = 'S3BackendSession'
-sqs_role_arn = f'arn:aws:iam::{account_id}:role/SQSAccessRole'
-sqs_session_name = 'SQSBackendSession'
-bucket_name = os.getenv('AWS_STORAGE_BUCKET_NAME')
-queue_url = os.getenv('AWS_SQS_QUEUE_URL')
-
-# Initialize AWSClientManager
-aws_manager = AWSClientManager(s3_role_arn, s3_session_name, sqs_role_arn, sqs_session_name, region_name)
+_manager = None
+_manager_lock = threading.Lock()
+
+def get_aws_manager():
+    """
+    Return the process-wide AWSClientManager, creating it on first use so
+    that importing this module (and booting Django) makes no AWS calls.
+    """
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                account_id = settings.AWS_ACCOUNT_ID
+                _manager = AWSClientManager(
+                    f'arn:aws:iam::{account_id}:role/S3AccessRole',
+                    'S3BackendSession',
+                    f'arn:aws:iam::{account_id}:role/SQSAccessRole',
+                    'SQSBackendSession',
+                    settings.AWS_REGION,
+                    settings.AWS_STORAGE_BUCKET_NAME,
+                    max_pool_connections=settings.AWS_MAX_POOL_CONNECTIONS
+                )
+    return _manager
+
+aws_manager = SimpleLazyObject(get_aws_manager)
@@ -1,18 +1,214 @@
-from .client import bucket_name, aws_manager
+import math
+import time
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from django.conf import settings
+from .client import aws_manager
+from .s3_url_cache import PresignedURLCache
+
+presigned_url_cache = PresignedURLCache(
+    max_size=settings.AWS_PRESIGNED_URL_CACHE_SIZE,
+    reuse_fraction=settings.AWS_PRESIGNED_URL_REUSE_FRACTION
+)
+
+# Large server-side uploads are split into parts sent by several threads
+transfer_config = TransferConfig(
+    multipart_threshold=settings.UPLOAD_PART_SIZE,
+    multipart_chunksize=settings.UPLOAD_PART_SIZE,
+    max_concurrency=settings.UPLOAD_MAX_CONCURRENCY
+)
+
+# Limits of S3 objects and multipart uploads
+S3_MAX_OBJECT_SIZE = 5 * 1024 ** 4
+S3_MAX_PARTS = 10000
 
 def list_files(prefix=''):
-    response = aws_manager.get_s3_client().list_objects_v2(Bucket=bucket_name, Prefix=prefix)
+    response = aws_manager.get_s3_client().list_objects_v2(Bucket=settings.AWS_STORAGE_BUCKET_NAME, Prefix=prefix)
     return response.get('Contents', [])
 
+def list_all_files(prefix):
+    """Every object under the prefix, following pagination."""
+    paginator = aws_manager.get_s3_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=settings.AWS_STORAGE_BUCKET_NAME, Prefix=prefix):
+        yield from page.get('Contents', [])
+
 def generate_presigned_url(file_name, expiration=3600):
-    return aws_manager.get_s3_client().generate_presigned_url(
-        'get_object',
-        Params={'Bucket': bucket_name, 'Key': file_name},
-        ExpiresIn=expiration
-    )
+    return generate_presigned_urls([file_name], expiration)[file_name]
+
+def generate_presigned_urls(file_names, expiration=3600):
+    """
+    Presign GET URLs for many object keys, signing only the ones that are
+    not cached. Returns a dict mapping each key to its URL.
+    """
+    urls = {}
+    missing = []
+    for file_name in file_names:
+        url = presigned_url_cache.get((file_name, expiration))
+        if url is None:
+            missing.append(file_name)
+        else:
+            urls[file_name] = url
+
+    if missing:
+        urls.update(aws_manager.get_s3_presigner().presign_many(missing, expiration))
+
+        # The URLs stop working when the temporary credentials that signed them expire
+        credentials_left = aws_manager.s3_expiration.timestamp() - time.time()
+        for file_name in missing:
+            presigned_url_cache.set((file_name, expiration), urls[file_name], min(expiration, credentials_left))
+
+    return urls
+
+def read_file(file_name):
+    response = aws_manager.get_s3_client().get_object(Bucket=settings.AWS_STORAGE_BUCKET_NAME, Key=file_name)
+    return response['Body'].read()
 
 def delete_file(file_name):
-    aws_manager.get_s3_client().delete_object(Bucket=bucket_name, Key=file_name)
+    aws_manager.get_s3_client().delete_object(Bucket=settings.AWS_STORAGE_BUCKET_NAME, Key=file_name)
+
+def delete_files(file_names):
+    """
+    Delete many objects with DeleteObjects calls of up to 1000 keys.
+    Returns the keys S3 failed to delete.
+    """
+    file_names = list(file_names)
+    failed = []
+    for start in range(0, len(file_names), 1000):
+        response = aws_manager.get_s3_client().delete_objects(
+            Bucket=settings.AWS_STORAGE_BUCKET_NAME,
+            Delete={
+                'Objects': [{'Key': file_name} for file_name in file_names[start:start + 1000]],
+                'Quiet': True
+            }
+        )
+        for error in response.get('Errors', []):
+            print(f"Failed to delete {error['Key']}: {error.get('Message')}")
+            failed.append(error['Key'])
+    return failed
+
+def copy_file(source_name, file_name):
+    """Server-side copy, in parts for large objects."""
+    aws_manager.get_s3_client().copy(
+        {'Bucket': settings.AWS_STORAGE_BUCKET_NAME, 'Key': source_name},
+        settings.AWS_STORAGE_BUCKET_NAME,
+        file_name,
+        Config=transfer_config
+    )
 
 def upload_file(file, file_name):
-    aws_manager.get_s3_client().upload_fileobj(file, bucket_name, file_name)
\ No newline at end of file
+    aws_manager.get_s3_client().upload_fileobj(
+        file,
+        settings.AWS_STORAGE_BUCKET_NAME,
+        file_name,
+        Config=transfer_config
+    )
+
+def head_file(file_name):
+    """Return the object's metadata, or None if it does not exist."""
+    try:
+        return aws_manager.get_s3_client().head_object(Bucket=settings.AWS_STORAGE_BUCKET_NAME, Key=file_name)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+
+def generate_presigned_post(file_name, max_size, expiration=3600):
+    """
+    Presign a browser POST upload of at most max_size bytes to file_name.
+    Returns a dict with the form 'url' and 'fields'.
+    """
+    return aws_manager.get_s3_client().generate_presigned_post(
+        Bucket=settings.AWS_STORAGE_BUCKET_NAME,
+        Key=file_name,
+        Conditions=[['content-length-range', 0, max_size]],
+        ExpiresIn=expiration
+    )
+
+def get_part_size(size, min_part_size):
+    return max(min_part_size, math.ceil(size / S3_MAX_PARTS))
+
+def create_multipart_upload(file_name):
+    response = aws_manager.get_s3_client().create_multipart_upload(
+        Bucket=settings.AWS_STORAGE_BUCKET_NAME,
+        Key=file_name
+    )
+    return response['UploadId']
+
+def generate_presigned_part_urls(file_name, upload_id, part_numbers, expiration=3600):
+    """Presign an upload_part PUT for each part number."""
+    s3_client = aws_manager.get_s3_client()
+    return {
+        part_number: s3_client.generate_presigned_url(
+            'upload_part',
+            Params={
+                'Bucket': settings.AWS_STORAGE_BUCKET_NAME,
+                'Key': file_name,
+                'UploadId': upload_id,
+                'PartNumber': part_number,
+            },
+            ExpiresIn=expiration
+        )
+        for part_number in part_numbers
+    }
+
+def upload_part(file_name, upload_id, part_number, body):
+    """Upload one part of a multipart upload and return its ETag."""
+    response = aws_manager.get_s3_client().upload_part(
+        Bucket=settings.AWS_STORAGE_BUCKET_NAME,
+        Key=file_name,
+        UploadId=upload_id,
+        PartNumber=part_number,
+        Body=body
+    )
+    return response['ETag']
+
+def complete_multipart_upload(file_name, upload_id, parts):
+    """
+    Complete a multipart upload. parts is a list of (part_number, etag).
+    """
+    aws_manager.get_s3_client().complete_multipart_upload(
+        Bucket=settings.AWS_STORAGE_BUCKET_NAME,
+        Key=file_name,
+        UploadId=upload_id,
+        MultipartUpload={
+            'Parts': [
+                {'PartNumber': part_number, 'ETag': etag}
+                for part_number, etag in sorted(parts)
+            ]
+        }
+    )
+
+def abort_multipart_upload(file_name, upload_id):
+    """Abort a multipart upload. Uploads already completed or aborted are ignored."""
+    try:
+        aws_manager.get_s3_client().abort_multipart_upload(
+            Bucket=settings.AWS_STORAGE_BUCKET_NAME,
+            Key=file_name,
+            UploadId=upload_id
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchUpload':
+            raise
+
+def list_parts(file_name, upload_id):
+    """
+    Return the parts S3 has stored for a multipart upload, in order, or None
+    if the upload no longer exists (it was completed or aborted).
+    """
+    paginator = aws_manager.get_s3_client().get_paginator('list_parts')
+    parts = []
+    try:
+        for page in paginator.paginate(Bucket=settings.AWS_STORAGE_BUCKET_NAME, Key=file_name, UploadId=upload_id):
+            parts.extend(page.get('Parts', []))
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchUpload':
+            return None
+        raise
+    return parts
+
+def list_multipart_uploads(prefix=''):
+    """Yield every multipart upload in progress under prefix."""
+    paginator = aws_manager.get_s3_client().get_paginator('list_multipart_uploads')
+    for page in paginator.paginate(Bucket=settings.AWS_STORAGE_BUCKET_NAME, Prefix=prefix):
+        yield from page.get('Uploads', [])
+
@@ -0,0 +1,101 @@
+import hashlib
+import hmac
+from datetime import datetime, timezone
+from urllib.parse import quote, urlsplit
+
+SIGV4_ALGORITHM = 'AWS4-HMAC-SHA256'
+SIGV4_TIMESTAMP = '%Y%m%dT%H%M%SZ'
+UNSIGNED_PAYLOAD = 'UNSIGNED-PAYLOAD'
+
+def _hmac(key, message):
+    return hmac.new(key, message.encode('utf-8'), hashlib.sha256).digest()
+
+class S3Presigner:
+    """
+    Presigns S3 GET URLs with SigV4 query authentication, producing the same
+    URLs as botocore's ``generate_presigned_url`` for an ``s3v4`` client.
+
+    botocore builds and signs a full request for every URL. This signer
+    only hashes the canonical request and reuses the derived signing key,
+    which only changes with the date, region and credentials.
+
+    ``credentials`` is a botocore credentials object; refreshable
+    credentials are read again on every batch.
+    """
+    def __init__(self, s3_client, bucket, credentials):
+        self.credentials = credentials
+        self.region = s3_client.meta.region_name
+
+        # Let botocore resolve the endpoint and addressing style for the
+        # bucket once, everything up to the key is the same for every URL
+        sample = urlsplit(s3_client.generate_presigned_url(
+            'get_object', Params={'Bucket': bucket, 'Key': '_'}
+        ))
+        self.base_url = f'{sample.scheme}://{sample.netloc}'
+        self.path_prefix = sample.path[:-1]
+        self.host = self._canonical_host(sample)
+
+        # ((date stamp, secret key), signing key) swapped as one object so
+        # threads never mix them
+        self._signing_key = (None, None)
+
+    @staticmethod
+    def _canonical_host(url):
+        host = url.hostname
+        if url.port is not None and not (
+            (url.scheme == 'https' and url.port == 443) or
+            (url.scheme == 'http' and url.port == 80)
+        ):
+            host = f'{host}:{url.port}'
+        return host
+
+    def get_signing_key(self, date_stamp, secret_key):
+        # Derived once per day and credentials, the region and service never change
+        cached_for, signing_key = self._signing_key
+        if cached_for != (date_stamp, secret_key):
+            signing_key = _hmac(f'AWS4{secret_key}'.encode('utf-8'), date_stamp)
+            signing_key = _hmac(signing_key, self.region)
+            signing_key = _hmac(signing_key, 's3')
+            signing_key = _hmac(signing_key, 'aws4_request')
+            self._signing_key = ((date_stamp, secret_key), signing_key)
+        return signing_key
+
+    def presign(self, key, expiration=3600, now=None):
+        return self.presign_many([key], expiration, now)[key]
+
+    def presign_many(self, keys, expiration=3600, now=None):
+        """
+        Presign GET URLs for many object keys at once, all sharing the same
+        timestamp. Returns a dict mapping each key to its URL.
+        """
+        credentials = self.credentials.get_frozen_credentials()
+        now = now or datetime.now(timezone.utc)
+        timestamp = now.strftime(SIGV4_TIMESTAMP)
+        date_stamp = timestamp[:8]
+        scope = f'{date_stamp}/{self.region}/s3/aws4_request'
+        signing_key = self.get_signing_key(date_stamp, credentials.secret_key)
+
+        params = [
+            ('X-Amz-Algorithm', SIGV4_ALGORITHM),
+            ('X-Amz-Credential', f'{credentials.access_key}/{scope}'),
+            ('X-Amz-Date', timestamp),
+            ('X-Amz-Expires', str(expiration)),
+            ('X-Amz-SignedHeaders', 'host'),
+        ]
+        if credentials.token:
+            params.append(('X-Amz-Security-Token', credentials.token))
+
+        encoded_params = [(quote(name, safe='-_.~'), quote(value, safe='-_.~')) for name, value in params]
+        query_string = '&'.join(f'{name}={value}' for name, value in encoded_params)
+        canonical_query_string = '&'.join(f'{name}={value}' for name, value in sorted(encoded_params))
+        canonical_suffix = f'\n{canonical_query_string}\nhost:{self.host}\n\nhost\n{UNSIGNED_PAYLOAD}'
+        string_to_sign_prefix = f'{SIGV4_ALGORITHM}\n{timestamp}\n{scope}\n'
+
+        urls = {}
+        for key in keys:
+            path = f'{self.path_prefix}{quote(key, safe="/~")}'
+            canonical_request = f'GET\n{path}{canonical_suffix}'
+            string_to_sign = string_to_sign_prefix + hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()
+            signature = hmac.new(signing_key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+            urls[key] = f'{self.base_url}{path}?{query_string}&X-Amz-Signature={signature}'
+        return urls
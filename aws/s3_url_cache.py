@@ -0,0 +1,53 @@
+import threading
+import time
+from collections import OrderedDict
+
+class PresignedURLCache:
+    """
+    In-process LRU cache of presigned URLs keyed by object key and expiry.
+
+    A cached URL is handed back until ``reuse_fraction`` of its lifetime has
+    passed, so callers always get a URL with a good part of its validity left
+    and repeated requests get the same, browser-cacheable URL.
+    """
+    def __init__(self, max_size=10000, reuse_fraction=0.5, clock=time.time):
+        self.max_size = max_size
+        self.reuse_fraction = reuse_fraction
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            url, reuse_until = entry
+            if self.clock() >= reuse_until:
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return url
+
+    def set(self, key, url, lifetime):
+        """
+        Store a URL valid for ``lifetime`` seconds from now. The lifetime
+        should already account for the signing credentials expiring.
+        """
+        if self.max_size <= 0 or lifetime <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (url, self.clock() + lifetime * self.reuse_fraction)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,28 +1,66 @@
 import json
-from .client import aws_manager, queue_url
+from django.conf import settings
+from .client import aws_manager
 
-def enqueue_json_object(dictionary):
+# Limits of a single SendMessageBatch call
+SQS_MAX_BATCH_ENTRIES = 10
+SQS_MAX_BATCH_BYTES = 256 * 1024
+
+JSON_MESSAGE_ATTRIBUTES = {
+    'ContentType': {
+        'StringValue': 'application/json',
+        'DataType': 'String'
+    }
+}
+
+def _message_size(message_body, message_attributes):
+    # SQS counts the body plus every attribute's name, type and value
+    size = len(message_body.encode('utf-8'))
+    for name, attribute in message_attributes.items():
+        size += len(name.encode('utf-8')) + len(attribute['DataType'].encode('utf-8'))
+        size += len(attribute.get('StringValue', '').encode('utf-8'))
+        size += len(attribute.get('BinaryValue', b''))
+    return size
+
+def send_json_objects(dictionaries):
     """
-    Enqueue a dictionary as a JSON object to the SQS queue.
+    Send dictionaries as JSON messages right away with
+    ``send_message_batch``, split into calls within the SQS batch limits.
+    Returns the errors of the dictionaries that were not sent, by index.
 
-    :param dictionary: The dictionary to be enqueued.
-    :return: The response from the SQS service.
+    Requests never call SQS: processing jobs are written to the outbox with
+    their file and sent from here by the ``dispatch_outbox`` command, which
+    batches the jobs of many requests and retries the failed ones.
     """
-    # Convert the dictionary to a JSON string
-    message_body = json.dumps(dictionary)
-
-    try:
-        response = aws_manager.get_sqs_client().send_message(
-            QueueUrl=queue_url,
-            MessageBody=message_body,
-            MessageAttributes={
-                'ContentType': {
-                    'StringValue': 'application/json',
-                    'DataType': 'String'
-                }
-            }
-        )
-        return response
-    except Exception as e:
-        print(f"Failed to enqueue JSON object: {str(e)}")
-        raise
\ No newline at end of file
+    sqs_client = aws_manager.get_sqs_client()
+    failed = {}
+
+    def send(chunk):
+        entries = [
+            {'Id': str(index), 'MessageBody': body, 'MessageAttributes': JSON_MESSAGE_ATTRIBUTES}
+            for index, body in chunk
+        ]
+        try:
+            response = sqs_client.send_message_batch(QueueUrl=settings.AWS_SQS_QUEUE_URL, Entries=entries)
+            for failure in response.get('Failed', []):
+                error = failure['Code']
+                if failure.get('Message'):
+                    error += f": {failure['Message']}"
+                failed[int(failure['Id'])] = error
+        except Exception as e:
+            print(f"Failed to send SQS batch: {str(e)}")
+            failed.update((index, f'{type(e).__name__}: {e}') for index, _ in chunk)
+
+    chunk, chunk_bytes = [], 0
+    for index, dictionary in enumerate(dictionaries):
+        body = json.dumps(dictionary)
+        size = _message_size(body, JSON_MESSAGE_ATTRIBUTES)
+        if chunk and (len(chunk) == SQS_MAX_BATCH_ENTRIES or chunk_bytes + size > SQS_MAX_BATCH_BYTES):
+            send(chunk)
+            chunk, chunk_bytes = [], 0
+        chunk.append((index, body))
+        chunk_bytes += size
+    if chunk:
+        send(chunk)
+
+    return failed
@@ -0,0 +1,36 @@
+"""
+Times the near-duplicate search of files.similarity on a synthetic library
+of random perceptual hashes, with a share of near-duplicates.
+
+Runs without a database:
+
+    python -m benchmarks.near_duplicates
+"""
+import random
+import time
+from files.similarity import find_similar, find_duplicate_groups, DEFAULT_DISTANCE, MAX_DISTANCE
+
+IMAGE_COUNT = 100_000
+DUPLICATE_COUNT = 1_000
+
+def main():
+    rng = random.Random(0)
+    hashes = {file_id: rng.getrandbits(64) for file_id in range(IMAGE_COUNT)}
+    # Copies of existing images with a few bits changed
+    for file_id in range(IMAGE_COUNT, IMAGE_COUNT + DUPLICATE_COUNT):
+        value = hashes[rng.randrange(IMAGE_COUNT)]
+        for _ in range(rng.randint(0, MAX_DISTANCE)):
+            value ^= 1 << rng.randrange(64)
+        hashes[file_id] = value
+
+    start = time.perf_counter()
+    find_similar(hashes[0], hashes, MAX_DISTANCE)
+    print(f'one image:          {time.perf_counter() - start:>6.3f} s')
+
+    for max_distance in (DEFAULT_DISTANCE, MAX_DISTANCE):
+        start = time.perf_counter()
+        groups = find_duplicate_groups(hashes, max_distance)
+        print(f'library, {max_distance} bits:   {time.perf_counter() - start:>6.3f} s, {len(groups)} groups')
+
+if __name__ == '__main__':
+    main()
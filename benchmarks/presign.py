@@ -0,0 +1,43 @@
+"""
+Compares botocore's generate_presigned_url with aws.s3_presigner.S3Presigner.
+
+Runs offline with dummy credentials:
+
+    python -m benchmarks.presign
+"""
+import time
+import boto3
+from botocore.config import Config
+from botocore.credentials import Credentials
+from aws.s3_presigner import S3Presigner
+
+BUCKET = 'simplebox-benchmark'
+KEY_COUNT = 2000
+
+def main():
+    s3_client = boto3.client(
+        's3',
+        aws_access_key_id='AKIDEXAMPLE',
+        aws_secret_access_key='secret',
+        aws_session_token='session-token',
+        region_name='sa-east-1',
+        config=Config(signature_version='s3v4')
+    )
+    presigner = S3Presigner(s3_client, BUCKET, Credentials('AKIDEXAMPLE', 'secret', 'session-token'))
+    keys = [f'users/1/files/video{i}.mp4/processed/720p.mp4' for i in range(KEY_COUNT)]
+
+    start = time.perf_counter()
+    for key in keys:
+        s3_client.generate_presigned_url('get_object', Params={'Bucket': BUCKET, 'Key': key}, ExpiresIn=3600)
+    botocore_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    presigner.presign_many(keys, 3600)
+    batch_elapsed = time.perf_counter() - start
+
+    print(f'botocore:  {KEY_COUNT / botocore_elapsed:>10.0f} URLs/s')
+    print(f'presigner: {KEY_COUNT / batch_elapsed:>10.0f} URLs/s')
+    print(f'speedup:   {botocore_elapsed / batch_elapsed:>10.1f}x')
+
+if __name__ == '__main__':
+    main()
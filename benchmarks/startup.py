@@ -0,0 +1,26 @@
+"""
+Measures how long it takes to boot Django and load the URLconf (which
+imports every view and the aws package), and checks that no AWS client was
+created on the way:
+
+    TEST_ENV=true python -m benchmarks.startup
+"""
+import os
+import time
+
+def main():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'simplebox.settings')
+
+    start = time.perf_counter()
+    import django
+    django.setup()
+    from django.urls import get_resolver
+    get_resolver().url_patterns
+    elapsed = time.perf_counter() - start
+
+    import aws.client
+    print(f'boot: {elapsed * 1000:.0f} ms')
+    print(f'AWS clients created during boot: {aws.client._manager is not None}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from files.models import BaseMediaFile, MEDIA_SUBCLASS_LINKS
+
+class Command(BaseCommand):
+    help = 'Sets BaseMediaFile.kind from the child table each existing file belongs to.'
+
+    def handle(self, *args, **options):
+        for kind, link in MEDIA_SUBCLASS_LINKS.items():
+            updated = (
+                BaseMediaFile.all_objects
+                .filter(**{f'{link}__isnull': False})
+                .exclude(kind=kind)
+                .update(kind=kind)
+            )
+            self.stdout.write(f'{kind}: {updated} files updated.')
+
+        self.stdout.write(self.style.SUCCESS('File kinds backfilled.'))
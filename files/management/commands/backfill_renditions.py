@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from files.models import VideoFile
+from aws.s3_objects import list_files
+
+class Command(BaseCommand):
+    help = (
+        'Builds the rendition manifest of videos processed before manifests '
+        'were stored, from the objects found under their processed/ prefix.'
+    )
+
+    def handle(self, *args, **options):
+        count = 0
+        for video in VideoFile.all_objects.filter(renditions=[], processed=True).iterator():
+            prefix = f'{video.storage_path}/processed/'
+            video.renditions = [
+                {
+                    # 'processed/720p.mp4' -> '720p'
+                    'resolution': item['Key'][len(prefix):].rsplit('.', 1)[0],
+                    'key': item['Key'][len(video.storage_path) + 1:],
+                    'bit_rate': None,
+                    'size': item['Size'],
+                }
+                for item in list_files(prefix=prefix)
+            ]
+            if video.renditions:
+                video.save(update_fields=['renditions'])
+                count += 1
+
+        self.stdout.write(self.style.SUCCESS(f'Backfilled {count} videos.'))
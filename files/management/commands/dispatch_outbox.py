@@ -0,0 +1,73 @@
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from files.models import OutboxMessage
+from aws.sqs import send_json_objects
+
+class Command(BaseCommand):
+    help = (
+        'Sends processing jobs from the outbox to SQS in batches. Jobs SQS '
+        'rejects are retried later with exponential backoff. Runs until '
+        'stopped, or until the outbox is drained with --once.'
+    )
+
+    # Seconds before the first retry, doubled on each failed attempt
+    base_backoff = 1
+    max_backoff = 300
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to wait when no job is due.')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once no job is due instead of polling.')
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            sent, due = self.dispatch(options['batch_size'])
+            total += sent
+            if due:
+                continue
+            if options['once']:
+                break
+            time.sleep(options['poll_interval'])
+
+        self.stdout.write(self.style.SUCCESS(f'Sent {total} processing jobs.'))
+
+    def dispatch(self, batch_size):
+        """
+        Send one batch of due jobs. Returns how many were sent and whether a
+        full batch was due (more may be waiting).
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            # Rows locked by another dispatcher are skipped, so several can run
+            messages = list(
+                OutboxMessage.objects.select_for_update(skip_locked=True)
+                .filter(next_attempt_at__lte=now)
+                .order_by('id')[:batch_size]
+            )
+            if not messages:
+                return 0, False
+
+            failed = send_json_objects([message.payload for message in messages])
+
+            retried = []
+            for index, message in enumerate(messages):
+                if index in failed:
+                    message.attempts += 1
+                    message.next_attempt_at = now + timedelta(
+                        seconds=min(self.base_backoff * 2 ** (message.attempts - 1), self.max_backoff)
+                    )
+                    message.last_error = failed[index]
+                    retried.append(message)
+
+            OutboxMessage.objects.filter(
+                id__in=[message.id for index, message in enumerate(messages) if index not in failed]
+            ).delete()
+            OutboxMessage.objects.bulk_update(retried, ['attempts', 'next_attempt_at', 'last_error'])
+
+        return len(messages) - len(failed), len(messages) == batch_size
@@ -0,0 +1,85 @@
+from collections import Counter
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from files.models import BaseMediaFile, StoredContent
+from files.search import remove_files
+from aws.s3_objects import delete_files, list_all_files
+
+class Command(BaseCommand):
+    help = (
+        'Deletes files that have been in the trash for longer than '
+        'FILE_TRASH_RETENTION, with their stored objects. Objects shared '
+        'with other files by content deduplication are kept until the last '
+        'file using them is purged.'
+    )
+
+    def add_arguments(self, parser):
+        # Up to 5 objects per file, so a batch is a few DeleteObjects calls
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - settings.FILE_TRASH_RETENTION
+        expired = (
+            BaseMediaFile.all_objects
+            .filter(deleted_at__lt=cutoff)
+            .with_subclasses()
+            .order_by('id')
+        )
+
+        count = 0
+        last_id = 0
+        while True:
+            files = [
+                file_instance.as_subclass()
+                for file_instance in expired.filter(id__gt=last_id)[:options['batch_size']]
+            ]
+            if not files:
+                break
+            last_id = files[-1].id
+
+            with transaction.atomic():
+                count += self.purge(files)
+
+        self.stdout.write(self.style.SUCCESS(f'Purged {count} files.'))
+
+    def purge(self, files):
+        """Purge a batch of files, returns how many were deleted."""
+        # Locked so no upload starts sharing content that is being deleted
+        contents = {
+            content.storage_key: content
+            for content in StoredContent.objects.select_for_update().filter(
+                storage_key__in=[f.storage_key for f in files if f.content_hash]
+            )
+        }
+        references = Counter(f.storage_key for f in files if f.storage_key in contents)
+
+        file_keys = {}
+        for file_instance in files:
+            content = contents.get(file_instance.storage_key)
+            if content is not None and content.ref_count > references[content.storage_key]:
+                # Still used by other files
+                file_keys[file_instance.id] = []
+                continue
+            keys = file_instance.get_storage_keys()
+            for prefix in file_instance.get_storage_prefixes():
+                keys += [item['Key'] for item in list_all_files(prefix)]
+            file_keys[file_instance.id] = keys
+        object_keys = list({key for keys in file_keys.values() for key in keys})
+        failed = set(delete_files(object_keys)) if object_keys else set()
+
+        # Files whose objects could not all be deleted are retried next run
+        file_ids = {file_id for file_id, keys in file_keys.items() if failed.isdisjoint(keys)}
+        purged = Counter(f.storage_key for f in files if f.id in file_ids and f.storage_key in contents)
+        for storage_key, purged_count in purged.items():
+            content = contents[storage_key]
+            if content.ref_count > references[storage_key]:
+                StoredContent.objects.filter(id=content.id).update(ref_count=F('ref_count') - purged_count)
+            else:
+                content.delete()
+
+        remove_files(list(file_ids))
+        BaseMediaFile.all_objects.filter(id__in=file_ids).delete()
+        return len(file_ids)
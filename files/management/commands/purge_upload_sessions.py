@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from files.models import UploadSession
+from aws.s3_objects import abort_multipart_upload, list_multipart_uploads
+
+class Command(BaseCommand):
+    help = (
+        'Aborts upload sessions and S3 multipart uploads older than '
+        'UPLOAD_SESSION_TTL so abandoned parts do not keep using storage.'
+    )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - settings.UPLOAD_SESSION_TTL
+
+        sessions = UploadSession.objects.filter(created_at__lt=cutoff)
+        session_count = sessions.count()
+        sessions.delete()
+
+        # S3 is the source of truth: this also catches uploads started by
+        # uploads/ without a session and sessions whose row was lost
+        upload_count = 0
+        for upload in list_multipart_uploads(prefix='users/'):
+            if upload['Initiated'] < cutoff:
+                abort_multipart_upload(upload['Key'], upload['UploadId'])
+                upload_count += 1
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Deleted {session_count} upload sessions and aborted {upload_count} multipart uploads.'
+        ))
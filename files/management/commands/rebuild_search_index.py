@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from files.models import BaseMediaFile
+from files.search import index_file, install_search_index
+
+class Command(BaseCommand):
+    help = 'Rebuilds the full-text search index for every media file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        install_search_index(sender=None)
+
+        files = (
+            BaseMediaFile.all_objects
+            .with_subclasses()
+            .prefetch_related('tags')
+            .order_by('id')
+        )
+
+        count = 0
+        for file in files.iterator(chunk_size=options['batch_size']):
+            index_file(file.as_subclass())
+            count += 1
+
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} files.'))
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum
+from files.models import BaseMediaFile, MediaKind, StorageUsage
+from user.models import User
+
+class Command(BaseCommand):
+    help = (
+        'Recounts the files of every user and repairs the StorageUsage rows '
+        'that drifted from them.'
+    )
+
+    def handle(self, *args, **options):
+        repaired = 0
+        for user_id in User.objects.order_by('user_id').values_list('user_id', flat=True).iterator():
+            with transaction.atomic():
+                # Locked before counting: updates made meanwhile wait and are
+                # applied on top of the recount
+                StorageUsage.objects.get_or_create(user_id=user_id)
+                usage = StorageUsage.objects.select_for_update().get(user_id=user_id)
+
+                counted = {f'{kind}_{unit}': 0 for kind in MediaKind.values for unit in ('files', 'bytes')}
+                totals = (
+                    BaseMediaFile.objects
+                    .filter(owner_id=user_id)
+                    .values('kind')
+                    .annotate(files=Count('id'), bytes=Sum('size'))
+                )
+                for total in totals:
+                    counted[f"{total['kind']}_files"] = total['files']
+                    counted[f"{total['kind']}_bytes"] = total['bytes']
+
+                changed = [name for name, value in counted.items() if getattr(usage, name) != value]
+                if changed:
+                    for name in changed:
+                        setattr(usage, name, counted[name])
+                    usage.save(update_fields=changed)
+                    repaired += 1
+
+        self.stdout.write(self.style.SUCCESS(f'Repaired the storage usage of {repaired} users.'))
@@ -0,0 +1,64 @@
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from files.models import BaseMediaFile, generate_storage_key
+from aws.s3_objects import list_all_files, copy_file, delete_files
+
+class Command(BaseCommand):
+    help = (
+        'Moves the objects of files still stored under their name '
+        '(users/<id>/files/<name>) to a stored, name-independent key.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.UPLOAD_MAX_CONCURRENCY)
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def copy_objects(self, file_instance):
+        """
+        Copy the original and derived objects to a new key. Returns the new
+        key, the old object keys and the copied object keys.
+        """
+        old_path = file_instance.storage_path
+        new_path = generate_storage_key(file_instance.owner_id)
+        # The prefix also matches other names starting with this one, so the
+        # listing can take several pages
+        old_keys = [
+            item['Key'] for item in list_all_files(old_path)
+            if item['Key'] == old_path or item['Key'].startswith(f'{old_path}/')
+        ]
+        new_keys = []
+        for old_key in old_keys:
+            new_key = new_path + old_key[len(old_path):]
+            copy_file(old_key, new_key)
+            new_keys.append(new_key)
+        return new_path, old_keys, new_keys
+
+    def handle(self, *args, **options):
+        # Files being processed still get objects written under the old key
+        legacy = (
+            BaseMediaFile.all_objects
+            .filter(storage_key__isnull=True, processed=True)
+            .order_by('id')
+        )
+
+        count = 0
+        last_id = 0
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            while True:
+                files = list(legacy.filter(id__gt=last_id)[:options['batch_size']])
+                if not files:
+                    break
+                last_id = files[-1].id
+
+                # Copies run in parallel, the database is updated from this thread
+                for file_instance, (new_path, old_keys, new_keys) in zip(files, executor.map(self.copy_objects, files)):
+                    updated = BaseMediaFile.all_objects.filter(
+                        id=file_instance.id, storage_key__isnull=True, name=file_instance.name
+                    ).update(storage_key=new_path)
+
+                    # Renamed or re-keyed meanwhile: the copies are not used
+                    delete_files(old_keys if updated else new_keys)
+                    count += updated
+
+        self.stdout.write(self.style.SUCCESS(f'Re-keyed {count} files.'))
@@ -1,4 +1,39 @@
+import uuid
+from collections import defaultdict
 from django.db import models
+from django.db.models import F
+from django.utils import timezone
+from . import search
+
+class MediaKind(models.TextChoices):
+    GENERIC = 'generic'
+    IMAGE = 'image'
+    VIDEO = 'video'
+    AUDIO = 'audio'
+
+# Implicit one-to-one parent link (e.g. ``basemediafile.imagefile``) of the
+# concrete BaseMediaFile child for each kind.
+MEDIA_SUBCLASS_LINKS = {
+    MediaKind.GENERIC: 'genericfile',
+    MediaKind.IMAGE: 'imagefile',
+    MediaKind.VIDEO: 'videofile',
+    MediaKind.AUDIO: 'audiofile',
+}
+
+# Kinds accepted by the ``type`` query parameter
+MEDIA_TYPE_FILTERS = (MediaKind.IMAGE, MediaKind.VIDEO, MediaKind.AUDIO)
+
+def generate_storage_key(owner_id):
+    """
+    A new, never reused object key for a file of the owner (owner_id is the
+    owner's user_id). Keys do not depend on the file name, so renaming a
+    file never moves its objects.
+    """
+    return f'users/{owner_id}/objects/{uuid.uuid4().hex}'
+
+def legacy_storage_key(owner_id, file_name):
+    # Key of files uploaded before keys were stored, see rekey_storage
+    return f'users/{owner_id}/files/{file_name}'
 
 class Tag(models.Model):
     name = models.CharField(max_length=50, unique=True)
@@ -6,34 +41,148 @@ class Tag(models.Model):
     def __str__(self):
         return self.name
 
+class MediaFileQuerySet(models.QuerySet):
+    def with_subclasses(self):
+        """
+        Join every child table so each row can be turned into its concrete
+        subclass with ``as_subclass()`` without further queries.
+        """
+        return self.select_related(*MEDIA_SUBCLASS_LINKS.values())
+
+    def of_types(self, types):
+        """
+        Restrict the queryset to the given media types ('image', 'video',
+        'audio'). An empty list or an empty string means every type.
+        """
+        if not types or '' in types:
+            return self
+
+        return self.filter(kind__in=[kind for kind in MEDIA_TYPE_FILTERS if kind in types])
+
+    def search(self, term, owner):
+        """
+        Full-text search over name, description, tag names and genre of the
+        owner's files, using the search index. Every word of the term is
+        matched as a prefix. Results are annotated with ``search_rank``
+        (higher is better).
+        """
+        if not term:
+            return self
+
+        tokens = search.tokenize(term)
+        if not tokens:
+            return self.none()
+
+        backend = search.get_backend(self.db)
+        query = backend.build_query(tokens)
+        return (
+            self.filter(id__in=backend.match(query, owner.pk))
+            .annotate(search_rank=backend.rank(query))
+        )
+
+class MediaFileManager(models.Manager.from_queryset(MediaFileQuerySet)):
+    """Default manager, leaves out files in the trash."""
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at__isnull=True)
+
 class BaseMediaFile(models.Model):
     name = models.CharField(max_length=255)
-    size = models.PositiveIntegerField()
+    size = models.PositiveBigIntegerField()
     upload_date = models.DateTimeField(auto_now_add=True)
     mime_type = models.CharField(max_length=50)
     description = models.TextField(null=True, blank=True)
     tags = models.ManyToManyField('Tag', related_name='%(class)s_media_files')
     owner = models.ForeignKey('user.User', on_delete=models.CASCADE)
     processed = models.BooleanField(default=False)
+    kind = models.CharField(max_length=10, choices=MediaKind.choices, default=MediaKind.GENERIC, db_index=True)
+    # Set when the file is moved to the trash, purge_deleted_files removes
+    # it for good once FILE_TRASH_RETENTION has passed
+    deleted_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    # Key of the original object, derived objects live under it. Null for
+    # files still stored under their name (legacy_storage_key)
+    # Files with the same content share it, see StoredContent
+    storage_key = models.CharField(max_length=255, null=True, blank=True, db_index=True)
+    # SHA-256 of the content, when it was computed during the upload
+    content_hash = models.CharField(max_length=64, null=True, blank=True)
+
+    # Kind stored by save(), overridden by each concrete child
+    media_kind = None
+
+    objects = MediaFileManager()
+    # Includes files in the trash
+    all_objects = MediaFileQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Keyset pagination walks each owner's files by (upload_date, id)
+            models.Index(fields=['owner', '-upload_date', '-id'], name='files_owner_upload_idx'),
+        ]
 
     def __str__(self):
         return self.name
-    
+
+    def save(self, *args, **kwargs):
+        if self.media_kind is not None:
+            self.kind = self.media_kind
+        super().save(*args, **kwargs)
+
+    def as_subclass(self):
+        """
+        Return the concrete child instance (ImageFile, VideoFile, ...) for
+        this row, or the row itself if it has no child. Only the child table
+        named by ``kind`` is read, so querysets built with
+        ``with_subclasses()`` resolve without further queries.
+        """
+        if self.media_kind is not None:
+            return self
+        try:
+            child = getattr(self, MEDIA_SUBCLASS_LINKS[self.kind])
+        except BaseMediaFile.DoesNotExist:
+            return self
+
+        # Hand prefetched relations (e.g. tags) over to the child instance
+        if hasattr(self, '_prefetched_objects_cache'):
+            child._prefetched_objects_cache = self._prefetched_objects_cache
+        return child
+
+    @property
+    def storage_path(self):
+        return self.storage_key or legacy_storage_key(self.owner_id, self.name)
+
+    def get_storage_keys(self):
+        """Keys of the original object and every object derived from it."""
+        return [self.storage_path]
+
+    def get_storage_prefixes(self):
+        """Prefixes of derived objects that are not listed one by one."""
+        return []
+
 class GenericFile(BaseMediaFile):
+    media_kind = MediaKind.GENERIC
+
     def __str__(self):
         return self.name
     
 class ImageFile(BaseMediaFile):
+    media_kind = MediaKind.IMAGE
+
     width = models.PositiveIntegerField()
     height = models.PositiveIntegerField()
     color_depth = models.PositiveIntegerField()
     resolution = models.CharField(max_length=50)
     exif_data = models.JSONField(null=True, blank=True)
+    # 64-bit perceptual hash as 16 hex digits, used to find near-duplicates
+    phash = models.CharField(max_length=16, null=True, blank=True)
 
     def __str__(self):
         return self.name
 
+    def get_storage_keys(self):
+        return super().get_storage_keys() + [f'{self.storage_path}/thumbnail.png']
+
 class VideoFile(BaseMediaFile):
+    media_kind = MediaKind.VIDEO
+
     duration = models.PositiveIntegerField()
     resolution = models.CharField(max_length=50)
     frame_rate = models.FloatField()
@@ -41,11 +190,40 @@ class VideoFile(BaseMediaFile):
     audio_codec = models.CharField(max_length=50)
     bit_rate = models.PositiveIntegerField()
     genre = models.CharField(max_length=50, null=True, blank=True)
+    # Renditions produced by processing, each a dict with resolution, key
+    # (relative to storage_path), bit_rate and size
+    renditions = models.JSONField(default=list, blank=True)
+    # HLS master playlist, relative to storage_path (e.g. 'hls/master.m3u8')
+    playlist = models.CharField(max_length=255, null=True, blank=True)
 
     def __str__(self):
         return self.name
 
+    def get_rendition_keys(self):
+        """Object key of each rendition in the manifest, by resolution."""
+        return {
+            rendition['resolution']: f"{self.storage_path}/{rendition['key']}"
+            for rendition in self.renditions
+        }
+
+    def get_storage_prefixes(self):
+        # Variant playlists and segments live next to the master playlist
+        if not self.playlist:
+            return []
+        directory = self.playlist.rsplit('/', 1)[0] if '/' in self.playlist else ''
+        return [f'{self.storage_path}/{directory}/' if directory else f'{self.storage_path}/']
+
+    def get_storage_keys(self):
+        # Thumbnail and the renditions the processing fleet reported
+        return (
+            super().get_storage_keys() +
+            [f'{self.storage_path}/thumbnail.png'] +
+            list(self.get_rendition_keys().values())
+        )
+
 class AudioFile(BaseMediaFile):
+    media_kind = MediaKind.AUDIO
+
     duration = models.PositiveIntegerField()  # duration in seconds
     bit_rate = models.PositiveIntegerField()
     sample_rate = models.PositiveIntegerField()
@@ -53,4 +231,122 @@ class AudioFile(BaseMediaFile):
     genre = models.CharField(max_length=50, null=True, blank=True)
 
     def __str__(self):
-        return self.name
\ No newline at end of file
+        return self.name
+
+class StoredContent(models.Model):
+    """
+    Content stored once for every file of an owner with the same SHA-256.
+    ``ref_count`` counts the files (trashed ones included) that use the
+    objects under ``storage_key``; they are deleted with the last one.
+    """
+    owner = models.ForeignKey('user.User', on_delete=models.CASCADE)
+    sha256 = models.CharField(max_length=64)
+    storage_key = models.CharField(max_length=255, unique=True)
+    size = models.PositiveBigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'sha256'], name='files_storedcontent_owner_sha256'),
+        ]
+
+    def __str__(self):
+        return self.sha256
+
+class StorageUsageManager(models.Manager):
+    def record(self, changes, using=None):
+        """
+        Add ``(user_id, kind, files, bytes)`` changes to the users' usage
+        rows, creating missing rows. Must run in the transaction that
+        changes the files, after their rows are written or locked.
+        """
+        values = defaultdict(lambda: defaultdict(int))
+        for user_id, kind, files, size in changes:
+            values[user_id][f'{kind}_files'] += files
+            values[user_id][f'{kind}_bytes'] += size
+
+        manager = self.db_manager(using)
+        # Always in the same order, so concurrent updates do not deadlock
+        for user_id in sorted(values):
+            updates = {name: F(name) + delta for name, delta in values[user_id].items() if delta}
+            if not updates:
+                continue
+            if not manager.filter(user_id=user_id).update(**updates):
+                manager.get_or_create(user_id=user_id)
+                manager.filter(user_id=user_id).update(**updates)
+
+class StorageUsage(models.Model):
+    """
+    Number and total size of a user's files per kind, kept up to date as
+    files are uploaded, processed, trashed and restored, so totals and
+    quotas never scan the file tables. Files in the trash are not counted.
+    reconcile_storage_usage repairs rows that drifted.
+    """
+    user = models.OneToOneField('user.User', on_delete=models.CASCADE, primary_key=True, related_name='storage_usage')
+    generic_files = models.BigIntegerField(default=0)
+    generic_bytes = models.BigIntegerField(default=0)
+    image_files = models.BigIntegerField(default=0)
+    image_bytes = models.BigIntegerField(default=0)
+    video_files = models.BigIntegerField(default=0)
+    video_bytes = models.BigIntegerField(default=0)
+    audio_files = models.BigIntegerField(default=0)
+    audio_bytes = models.BigIntegerField(default=0)
+
+    objects = StorageUsageManager()
+
+    @property
+    def total_files(self):
+        return sum(getattr(self, f'{kind}_files') for kind in MediaKind.values)
+
+    @property
+    def total_bytes(self):
+        return sum(getattr(self, f'{kind}_bytes') for kind in MediaKind.values)
+
+    def __str__(self):
+        return f'{self.user_id}: {self.total_bytes} bytes'
+
+class UploadSession(models.Model):
+    """
+    A resumable upload backed by an S3 multipart upload. S3 is the source of
+    truth for which parts are stored; the row keeps what is needed to sign
+    part URLs and to complete or abort the upload.
+    """
+    owner = models.ForeignKey('user.User', on_delete=models.CASCADE)
+    name = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    part_size = models.PositiveBigIntegerField()
+    upload_id = models.CharField(max_length=1024)
+    storage_key = models.CharField(max_length=255, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'name'], name='files_uploadsession_owner_name'),
+        ]
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def storage_path(self):
+        return self.storage_key or legacy_storage_key(self.owner_id, self.name)
+
+    @property
+    def part_count(self):
+        return max(1, -(-self.size // self.part_size))
+
+class OutboxMessage(models.Model):
+    """
+    A processing job waiting to be sent to SQS. Rows are written in the
+    same transaction as the file they refer to and deleted by the
+    ``dispatch_outbox`` command once SQS has accepted them, so a job is
+    never lost; it may be delivered more than once.
+    """
+    payload = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now, db_index=True)
+    last_error = models.TextField(null=True, blank=True)
+
+    def __str__(self):
+        return f'Outbox message {self.id}'
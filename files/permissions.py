@@ -1,3 +1,5 @@
+import hmac
+from django.conf import settings
 from rest_framework.permissions import BasePermission
 from rest_framework.exceptions import PermissionDenied
 from ipaddress import ip_address, ip_network
@@ -26,3 +28,14 @@ class IsPrivateSubnet(BasePermission):
         if not any(remote_ip in subnet for subnet in self.subnets):
             raise PermissionDenied("Access denied.")
         return True
+
+class HasWebhookSecret(BasePermission):
+    """
+    Only allow requests carrying the WEBHOOK_SECRET setting in the
+    X-Webhook-Secret header. Every request is refused if it is not set.
+    """
+    def has_permission(self, request, view):
+        secret = request.META.get('HTTP_X_WEBHOOK_SECRET', '')
+        if not settings.WEBHOOK_SECRET or not hmac.compare_digest(secret.encode(), settings.WEBHOOK_SECRET.encode()):
+            raise PermissionDenied("Access denied.")
+        return True
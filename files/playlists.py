@@ -0,0 +1,75 @@
+"""
+HLS playlists served through the API.
+
+Videos processed for adaptive streaming store a master playlist under their
+storage path. The bucket is private, so the playlists are served by the API
+with their URIs rewritten: variant playlists point back to the API, which
+rewrites them in turn, and segments, keys and init sections point to an API
+endpoint that redirects to a presigned S3 URL. URLs are signed when the
+player fetches each segment, so a media playlist loaded once plays to the
+end whatever the lifetime of the credentials. Rewritten playlists hold no
+signed URLs and are cached per user and file.
+"""
+import hashlib
+import posixpath
+import re
+from django.conf import settings
+from django.core.cache import cache
+from aws.s3_objects import read_file
+
+PLAYLIST_CONTENT_TYPE = 'application/vnd.apple.mpegurl'
+
+URI_ATTRIBUTE = re.compile(r'URI="([^"]*)"')
+
+def is_playlist(path):
+    return path.split('?', 1)[0].endswith('.m3u8')
+
+def resolve_uri(uri, playlist_path):
+    """
+    Path of a relative URI, relative to the file's storage path, or None
+    for absolute URLs and paths outside the file's objects.
+    """
+    if not uri or '://' in uri or uri.startswith('/'):
+        return None
+    path = posixpath.normpath(posixpath.join(posixpath.dirname(playlist_path), uri.split('?', 1)[0]))
+    if path.startswith('../') or path == '..':
+        return None
+    return path
+
+def rewrite_playlist(text, playlist_path, variant_url, segment_url):
+    """
+    Rewrite the URIs of an HLS playlist stored at ``playlist_path``
+    (relative to the video's storage path). ``variant_url`` builds the API
+    URL of a variant playlist from its path, ``segment_url`` the one of any
+    other object.
+    """
+    def replace(uri):
+        path = resolve_uri(uri, playlist_path)
+        if path is None:
+            return uri
+        if is_playlist(path):
+            return variant_url(path)
+        return segment_url(path)
+
+    rewritten = []
+    for line in text.splitlines():
+        if line.startswith('#'):
+            line = URI_ATTRIBUTE.sub(lambda match: f'URI="{replace(match.group(1))}"', line)
+        elif line.strip():
+            line = replace(line.strip())
+        rewritten.append(line)
+    return '\n'.join(rewritten) + '\n'
+
+def get_playlist(video, playlist_path, user_id, variant_url, segment_url):
+    """
+    The rewritten playlist at ``playlist_path`` of a video, from the cache
+    when this user already got it.
+    """
+    digest = hashlib.sha256(f'{video.storage_path}/{playlist_path}'.encode('utf-8')).hexdigest()
+    cache_key = f'files:playlist:{user_id}:{video.id}:{digest}'
+    playlist = cache.get(cache_key)
+    if playlist is None:
+        text = read_file(f'{video.storage_path}/{playlist_path}').decode('utf-8')
+        playlist = rewrite_playlist(text, playlist_path, variant_url, segment_url)
+        cache.set(cache_key, playlist, settings.PLAYLIST_CACHE_TIMEOUT)
+    return playlist
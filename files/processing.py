@@ -0,0 +1,242 @@
+"""
+Applies the results sent back by the processing fleet.
+
+A processed file keeps its id, parent row and tags: its ``BaseMediaFile``
+row is updated in place and, when the file turns out to be an image, video
+or audio file, its ``GenericFile`` child row is swapped for a row in the
+matching child table. Results are applied in bulk, with one query per table
+for a whole batch.
+"""
+from django.core.exceptions import ValidationError
+from django.db import connections, transaction
+from .models import BaseMediaFile, GenericFile, ImageFile, VideoFile, AudioFile, MediaKind, StorageUsage
+
+# Child model and the fields read from a result's ``data`` for each kind
+MEDIA_MODELS = {
+    MediaKind.IMAGE: (ImageFile, ['width', 'height', 'color_depth', 'resolution', 'exif_data', 'phash']),
+    MediaKind.VIDEO: (VideoFile, ['duration', 'resolution', 'frame_rate', 'video_codec', 'audio_codec', 'bit_rate', 'renditions', 'playlist']),
+    MediaKind.AUDIO: (AudioFile, ['duration', 'bit_rate', 'sample_rate', 'channels']),
+}
+
+# Per-item statuses
+PROCESSED = 'processed'
+ALREADY_PROCESSED = 'already_processed'
+NOT_FOUND = 'not_found'
+INVALID = 'invalid'
+DUPLICATE = 'duplicate'
+
+def kind_for_mime_type(mime_type):
+    for kind in MEDIA_MODELS:
+        if mime_type.startswith(f'{kind}/'):
+            return kind
+    return MediaKind.GENERIC
+
+def build_child(model, field_names, parent, data):
+    """
+    Return an unsaved ``model`` instance for the parent row, with the
+    fields read from ``data``. Raises ValidationError for missing or
+    malformed values.
+    """
+    values = {}
+    for name in field_names:
+        field = model._meta.get_field(name)
+        value = data.get(name)
+        if value is None:
+            if field.has_default():
+                values[name] = field.get_default()
+            elif not field.null:
+                raise ValidationError(f'{name} is required.')
+            else:
+                values[name] = None
+        else:
+            values[name] = field.clean(value, None)
+
+    if 'renditions' in values:
+        values['renditions'] = clean_renditions(values['renditions'], parent.storage_path)
+    if values.get('playlist') is not None:
+        values['playlist'] = clean_key(values['playlist'], parent.storage_path, 'playlist')
+    if values.get('phash') is not None:
+        values['phash'] = clean_phash(values['phash'])
+
+    parent_values = {field.attname: getattr(parent, field.attname) for field in BaseMediaFile._meta.concrete_fields}
+    return model(basemediafile_ptr_id=parent.id, **parent_values, **values)
+
+def clean_key(key, storage_path, label):
+    """
+    A key of a derived object, relative to the file's storage path. Keys
+    may be sent relative or absolute but must stay under the file's objects.
+    """
+    if isinstance(key, str) and key.startswith(f'{storage_path}/'):
+        key = key[len(storage_path) + 1:]
+    if not isinstance(key, str) or not key or key.startswith('/') or '..' in key.split('/'):
+        raise ValidationError(f'Invalid key for {label}.')
+    return key
+
+def clean_phash(phash):
+    """A 64-bit perceptual hash, sent as 16 hex digits."""
+    if len(phash) != 16 or not all(c in '0123456789abcdefABCDEF' for c in phash):
+        raise ValidationError('phash must be 16 hex digits.')
+    return phash.lower()
+
+def clean_renditions(renditions, storage_path):
+    """
+    Validate a video's rendition manifest: a list of dicts with
+    ``resolution``, ``key`` and optional ``bit_rate`` and ``size``. Keys are
+    stored relative to the file's storage path (e.g. ``processed/720p.mp4``)
+    and may be sent either way.
+    """
+    if not isinstance(renditions, list):
+        raise ValidationError('renditions must be a list.')
+
+    cleaned = []
+    for rendition in renditions:
+        if not isinstance(rendition, dict):
+            raise ValidationError('renditions must be a list of objects.')
+        resolution = rendition.get('resolution')
+        if not isinstance(resolution, str) or not resolution:
+            raise ValidationError('Every rendition needs a resolution.')
+        key = clean_key(rendition.get('key'), storage_path, f'rendition {resolution}')
+
+        numbers = {}
+        for name in ('bit_rate', 'size'):
+            value = rendition.get(name)
+            if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < 0):
+                raise ValidationError(f'Invalid {name} for rendition {resolution}.')
+            numbers[name] = value
+        cleaned.append({'resolution': resolution, 'key': key, **numbers})
+
+    if len({rendition['resolution'] for rendition in cleaned}) != len(cleaned):
+        raise ValidationError('Rendition resolutions must be unique.')
+    return cleaned
+
+def copy_processed_file(source, **values):
+    """
+    Create a new file of the same concrete class as ``source`` with its
+    processing result and stored objects, and the given field values.
+    """
+    model = type(source)
+    copied = {
+        field.attname: getattr(source, field.attname)
+        for field in model._meta.concrete_fields
+        if not field.primary_key
+    }
+    return model.objects.create(**{**copied, 'description': None, 'deleted_at': None, **values})
+
+def _delete_generic_rows(file_ids, using):
+    # Only the child rows: the parent row, its tags and search document stay
+    connection = connections[using]
+    table = connection.ops.quote_name(GenericFile._meta.db_table)
+    column = connection.ops.quote_name(GenericFile._meta.pk.column)
+    placeholders = ', '.join(['%s'] * len(file_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {table} WHERE {column} IN ({placeholders})', file_ids)
+
+def parse_file_id(value):
+    """The file id in ``value``, an int or a numeric string, or None."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def apply_processing_results(results, using='default'):
+    """
+    Apply a batch of processing results in one transaction. Each result is
+    a dict with ``file_id``, ``mime_type`` and ``data``.
+
+    Returns one ``{'file_id', 'status'}`` dict per result, in order, plus an
+    ``error`` for invalid results, and the processed files by id. Results
+    for files that are already processed are reported as such and not
+    applied again, so a batch can safely be retried.
+    """
+    statuses = [None] * len(results)
+    wanted = {}
+    for index, result in enumerate(results):
+        file_id = parse_file_id(result.get('file_id')) if isinstance(result, dict) else None
+        mime_type = result.get('mime_type') if isinstance(result, dict) else None
+        if file_id is None or not isinstance(mime_type, str):
+            statuses[index] = {'file_id': file_id, 'status': INVALID, 'error': 'file_id and mime_type are required.'}
+        elif file_id in wanted:
+            statuses[index] = {'file_id': file_id, 'status': DUPLICATE}
+        else:
+            wanted[file_id] = index
+
+    processed = {}
+    with transaction.atomic(using=using):
+        parents = {
+            parent.id: parent
+            for parent in BaseMediaFile.all_objects.using(using).select_for_update().filter(id__in=list(wanted))
+        }
+
+        children = {kind: [] for kind in MEDIA_MODELS}
+        updated_parents = []
+        usage_changes = []
+
+        def promote(parent, result):
+            """Apply a result to a parent row, return the file or raise ValidationError."""
+            data = result.get('data') or {}
+            kind = kind_for_mime_type(result['mime_type'])
+            file_instance = parent
+            if kind != MediaKind.GENERIC and parent.kind == MediaKind.GENERIC:
+                model, field_names = MEDIA_MODELS[kind]
+                parent.kind = kind
+                parent.mime_type = result['mime_type']
+                parent.processed = True
+                file_instance = build_child(model, field_names, parent, data)
+                children[kind].append(file_instance)
+                # Trashed files are not counted
+                if parent.deleted_at is None:
+                    usage_changes.append((parent.owner_id, MediaKind.GENERIC, -1, -parent.size))
+                    usage_changes.append((parent.owner_id, kind, 1, parent.size))
+            else:
+                parent.mime_type = result['mime_type']
+                parent.processed = True
+
+            updated_parents.append(parent)
+            return file_instance
+
+        for file_id, index in wanted.items():
+            parent = parents.get(file_id)
+            if parent is None:
+                statuses[index] = {'file_id': file_id, 'status': NOT_FOUND}
+                continue
+            if parent.processed:
+                statuses[index] = {'file_id': file_id, 'status': ALREADY_PROCESSED}
+                continue
+
+            try:
+                processed[file_id] = promote(parent, results[index])
+            except ValidationError as e:
+                statuses[index] = {'file_id': file_id, 'status': INVALID, 'error': ' '.join(e.messages)}
+                continue
+            statuses[index] = {'file_id': file_id, 'status': PROCESSED}
+
+        # Files uploaded later with the same content were not queued, they
+        # share the result of the file that was
+        shared_keys = {
+            parents[file_id].storage_key: file_id
+            for file_id in processed if parents[file_id].content_hash
+        }
+        if shared_keys:
+            siblings = (
+                BaseMediaFile.all_objects.using(using).select_for_update()
+                .filter(storage_key__in=list(shared_keys), processed=False)
+                .exclude(id__in=list(wanted))
+            )
+            for sibling in siblings:
+                promote(sibling, results[wanted[shared_keys[sibling.storage_key]]])
+
+        BaseMediaFile.all_objects.using(using).bulk_update(updated_parents, ['mime_type', 'processed', 'kind'])
+
+        promoted_ids = [child.id for kind_children in children.values() for child in kind_children]
+        if promoted_ids:
+            _delete_generic_rows(promoted_ids, using)
+        for kind, kind_children in children.items():
+            if kind_children:
+                model = MEDIA_MODELS[kind][0]
+                # bulk_create refuses multi-table models, insert the child rows only
+                model._base_manager.using(using)._insert(
+                    kind_children, fields=model._meta.local_concrete_fields, using=using
+                )
+        StorageUsage.objects.record(usage_changes, using=using)
+
+    return statuses, processed
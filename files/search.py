@@ -0,0 +1,156 @@
+"""
+Full-text search index for media files.
+
+Each file has one document in the ``files_search_index`` table built from its
+name, description, tag names and genre. On Postgres the document is a weighted
+``tsvector`` behind a GIN index; under TEST_ENV (SQLite) the table is an FTS5
+virtual table. The table is created by ``install_search_index`` after
+migrations run and kept current by the views that write files.
+"""
+import re
+from django.db import connections
+from django.db.models import FloatField
+from django.db.models.expressions import RawSQL
+
+SEARCH_TABLE = 'files_search_index'
+FILES_TABLE = 'files_basemediafile'
+
+def tokenize(text):
+    """
+    Split text into lowercase word tokens, dropping punctuation so that
+    'photo.png' is indexed and searched as 'photo' and 'png'.
+    """
+    return re.findall(r'\w+', (text or '').lower())
+
+class PostgresSearchBackend:
+    def install(self, cursor):
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {SEARCH_TABLE} (
+                file_id bigint PRIMARY KEY REFERENCES {FILES_TABLE} (id) ON DELETE CASCADE,
+                owner_id integer NOT NULL,
+                document tsvector NOT NULL
+            )
+        ''')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {SEARCH_TABLE}_document ON {SEARCH_TABLE} USING gin (document)')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {SEARCH_TABLE}_owner ON {SEARCH_TABLE} (owner_id)')
+
+    def index(self, cursor, file_id, owner_id, name, description, tags, genre):
+        cursor.execute(f'''
+            INSERT INTO {SEARCH_TABLE} (file_id, owner_id, document)
+            VALUES (
+                %s, %s,
+                setweight(to_tsvector('simple', %s), 'A') ||
+                setweight(to_tsvector('simple', %s), 'B') ||
+                setweight(to_tsvector('simple', %s), 'B') ||
+                setweight(to_tsvector('simple', %s), 'C')
+            )
+            ON CONFLICT (file_id) DO UPDATE
+            SET owner_id = EXCLUDED.owner_id, document = EXCLUDED.document
+        ''', [file_id, owner_id, name, tags, genre, description])
+
+    def remove(self, cursor, file_ids):
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE file_id = ANY(%s)', [list(file_ids)])
+
+    def build_query(self, tokens):
+        # Prefix match on every token: 'beach tri' -> 'beach:* & tri:*'
+        return ' & '.join(f'{token}:*' for token in tokens)
+
+    def match(self, query, owner_id):
+        return RawSQL(
+            f"SELECT file_id FROM {SEARCH_TABLE} "
+            f"WHERE owner_id = %s AND document @@ to_tsquery('simple', %s)",
+            [owner_id, query]
+        )
+
+    def rank(self, query):
+        return RawSQL(
+            f"SELECT ts_rank(document, to_tsquery('simple', %s)) FROM {SEARCH_TABLE} "
+            f"WHERE file_id = {FILES_TABLE}.id",
+            [query],
+            output_field=FloatField()
+        )
+
+class SQLiteSearchBackend:
+    # bm25 weights for name, description, tags and genre
+    weights = '10.0, 2.0, 5.0, 5.0'
+
+    def install(self, cursor):
+        cursor.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5(
+                name, description, tags, genre, owner_id UNINDEXED,
+                tokenize = 'unicode61 remove_diacritics 2'
+            )
+        ''')
+
+    def index(self, cursor, file_id, owner_id, name, description, tags, genre):
+        # FTS5 has no upsert, the rowid is the file id
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE rowid = %s', [file_id])
+        cursor.execute(
+            f'INSERT INTO {SEARCH_TABLE} (rowid, name, description, tags, genre, owner_id) '
+            f'VALUES (%s, %s, %s, %s, %s, %s)',
+            [file_id, name, description, tags, genre, owner_id]
+        )
+
+    def remove(self, cursor, file_ids):
+        file_ids = list(file_ids)
+        placeholders = ', '.join(['%s'] * len(file_ids))
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE rowid IN ({placeholders})', file_ids)
+
+    def build_query(self, tokens):
+        # Prefix match on every token: 'beach tri' -> '"beach"* "tri"*'
+        return ' '.join(f'"{token}"*' for token in tokens)
+
+    def match(self, query, owner_id):
+        return RawSQL(
+            f"SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s AND owner_id = %s",
+            [query, owner_id]
+        )
+
+    def rank(self, query):
+        # bm25 is lower for better matches, negate it so higher is better
+        return RawSQL(
+            f"SELECT -bm25({SEARCH_TABLE}, {self.weights}) FROM {SEARCH_TABLE} "
+            f"WHERE {SEARCH_TABLE} MATCH %s AND rowid = {FILES_TABLE}.id",
+            [query],
+            output_field=FloatField()
+        )
+
+BACKENDS = {
+    'postgresql': PostgresSearchBackend(),
+    'sqlite': SQLiteSearchBackend(),
+}
+
+def get_backend(using='default'):
+    return BACKENDS[connections[using].vendor]
+
+def index_file(file_instance, using='default'):
+    """
+    Insert or refresh the search document of a file. Uses prefetched tags
+    when available.
+    """
+    genre = getattr(file_instance, 'genre', None)
+    fields = [
+        file_instance.name,
+        file_instance.description,
+        ' '.join(tag.name for tag in file_instance.tags.all()),
+        genre,
+    ]
+    with connections[using].cursor() as cursor:
+        get_backend(using).index(
+            cursor,
+            file_instance.id,
+            file_instance.owner_id,
+            *(' '.join(tokenize(field)) for field in fields)
+        )
+
+def remove_files(file_ids, using='default'):
+    file_ids = list(file_ids)
+    if not file_ids:
+        return
+    with connections[using].cursor() as cursor:
+        get_backend(using).remove(cursor, file_ids)
+
+def install_search_index(sender, using='default', **kwargs):
+    """post_migrate handler that creates the search table if it is missing."""
+    with connections[using].cursor() as cursor:
+        get_backend(using).install(cursor)
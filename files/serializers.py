@@ -1,6 +1,7 @@
+from django.urls import reverse
 from rest_framework import serializers
-from .models import GenericFile, ImageFile, VideoFile, AudioFile, Tag
-from aws.s3_objects import generate_presigned_url
+from .models import GenericFile, ImageFile, VideoFile, AudioFile, Tag, UploadSession, MediaKind
+from aws.s3_objects import generate_presigned_urls
 
 class TagSerializer(serializers.ModelSerializer):
     class Meta:
@@ -15,30 +16,100 @@ class BaseMediaFileSerializer(serializers.ModelSerializer):
         read_only_fields = ['size']
 
 class MixedFileSerializer(serializers.Serializer):
-    def to_representation(self, instance):
-        file_path = f'users/{instance.owner.user_id}/files/{instance.name}'
+    """
+    Serializes any media file with the serializer of its concrete class.
+    Expects ``tags`` to be prefetched when serializing many files.
+
+    Supports sparse fieldsets through the request's query parameters:
+    ``?fields=id,name,thumbnail_url`` returns only the listed members and
+    ``?expand=exif_data`` adds heavy members to the response. Heavy members
+    are only returned when requested by either parameter, so by default no
+    URLs are signed for them. Members that are not returned are not
+    computed. Without a request, the full representation is returned.
+    """
+    heavy_fields = {'exif_data', 'thumbnail_url', 'processed_video_urls'}
+
+    def get_requested_fields(self):
+        # Parsed once and shared by every item of a list
+        if not hasattr(self, '_requested_fields'):
+            request = self.context.get('request')
+            if request is None:
+                self._requested_fields = (None, set(self.heavy_fields))
+            else:
+                fields = request.query_params.get('fields')
+                expand = request.query_params.get('expand')
+                self._requested_fields = (
+                    set(fields.split(',')) if fields else None,
+                    set(expand.split(',')) if expand else set(),
+                )
+        return self._requested_fields
+
+    def is_requested(self, field_name):
+        fields, expand = self.get_requested_fields()
+        if field_name in expand:
+            return True
+        if fields is not None:
+            return field_name in fields
+        return field_name not in self.heavy_fields
+
+    def get_concrete_serializer(self, instance):
+        # One serializer per concrete class, reused for every item of a list
+        if not hasattr(self, '_concrete_serializers'):
+            self._concrete_serializers = {}
 
         if isinstance(instance, ImageFile):
-            data = ImageFileSerializer(instance).data
-            data['thumbnail_url'] = generate_presigned_url(f'{file_path}/thumbnail.png')
+            serializer_class = ImageFileSerializer
         elif isinstance(instance, VideoFile):
-            data = VideoFileSerializer(instance).data
-            data['thumbnail_url'] = generate_presigned_url(f'{file_path}/thumbnail.png')
-            data['processed_video_urls'] = {
-                '480p': generate_presigned_url(f'{file_path}/processed/480p.mp4'),
-                '720p': generate_presigned_url(f'{file_path}/processed/720p.mp4'),
-                '1080p': generate_presigned_url(f'{file_path}/processed/1080p.mp4'),
-            }
+            serializer_class = VideoFileSerializer
         elif isinstance(instance, AudioFile):
-            data = AudioFileSerializer(instance).data
+            serializer_class = AudioFileSerializer
         else:
-            data = GenericFileSerializer(instance).data
-        
+            serializer_class = GenericFileSerializer
+
+        if serializer_class not in self._concrete_serializers:
+            serializer = serializer_class()
+            for field_name in list(serializer.fields):
+                if not self.is_requested(field_name):
+                    serializer.fields.pop(field_name)
+            self._concrete_serializers[serializer_class] = serializer
+        return self._concrete_serializers[serializer_class]
+
+    def to_representation(self, instance):
+        file_path = instance.storage_path
+        data = self.get_concrete_serializer(instance).to_representation(instance)
+
+        # Collect every URL this item needs and sign them in one batch
+        paths = {}
+        if self.is_requested('url'):
+            paths['url'] = file_path
+        if isinstance(instance, (ImageFile, VideoFile)) and self.is_requested('thumbnail_url'):
+            paths['thumbnail_url'] = f'{file_path}/thumbnail.png'
+        # Only the renditions processing actually produced
+        rendition_paths = None
+        if isinstance(instance, VideoFile) and self.is_requested('processed_video_urls'):
+            rendition_paths = instance.get_rendition_keys()
+
+        keys = list(paths.values()) + list((rendition_paths or {}).values())
+        urls = generate_presigned_urls(keys) if keys else {}
+
+        if 'thumbnail_url' in paths:
+            data['thumbnail_url'] = urls[paths['thumbnail_url']]
+        if rendition_paths is not None:
+            data['processed_video_urls'] = {
+                resolution: urls[path] for resolution, path in rendition_paths.items()
+            }
+
+        # Adaptive streaming is served by the API, see FileViewSet.playlist
+        request = self.context.get('request')
+        if isinstance(instance, VideoFile) and instance.playlist and request is not None and self.is_requested('playlist_url'):
+            data['playlist_url'] = request.build_absolute_uri(reverse('file-playlist', args=[instance.id]))
+
         # Format tags as a list of strings
         if 'tags' in data:
-            data['tags'] = [tag.name for tag in instance.tags.all()]
+            data['tags'] = [tag['name'] for tag in data['tags']]
 
-        data['url'] = generate_presigned_url(file_path)
+        if 'url' in paths:
+            data['url'] = urls[paths['url']]
 
         return data
 
@@ -80,3 +151,23 @@ class AudioFileSerializer(BaseMediaFileSerializer):
     class Meta(BaseMediaFileSerializer.Meta):
         model = AudioFile
         fields = BaseMediaFileSerializer.Meta.fields + ['duration', 'bit_rate', 'sample_rate', 'channels', 'genre']
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    part_count = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = UploadSession
+        fields = ['id', 'name', 'size', 'part_size', 'part_count', 'created_at']
+
+
+class StorageUsageSerializer(serializers.Serializer):
+    """A user's file count and bytes, in total and per kind."""
+    def to_representation(self, usage):
+        return {
+            'files': usage.total_files,
+            'bytes': usage.total_bytes,
+            'kinds': {
+                kind: {'files': getattr(usage, f'{kind}_files'), 'bytes': getattr(usage, f'{kind}_bytes')}
+                for kind in MediaKind.values
+            },
+        }
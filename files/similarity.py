@@ -0,0 +1,91 @@
+"""
+Near-duplicate search over the perceptual hashes of images.
+
+Images processed by the fleet carry a 64-bit perceptual hash; visually
+similar images have hashes a few bits apart. A single image is compared
+with the whole library by XOR and popcount. Whole libraries are searched
+with a multi-index: each hash is split into four 16-bit blocks and two
+hashes at most ``d`` bits apart have a block at most ``d // 4`` bits apart,
+so only hashes found in a block table at that radius are compared, instead
+of every pair.
+"""
+from collections import defaultdict
+from itertools import combinations
+
+# Distance used when none is given, and the largest one allowed. Up to 3
+# bits only identical blocks are looked up; from 4 every block one bit away
+# is looked up too, which is several times slower
+DEFAULT_DISTANCE = 3
+MAX_DISTANCE = 7
+
+BLOCKS = 4
+BLOCK_BITS = 16
+BLOCK_MASK = (1 << BLOCK_BITS) - 1
+
+def find_similar(target, hashes, max_distance):
+    """
+    The ``(id, distance)`` pairs of ``hashes`` (a dict of ids to integer
+    hashes) at most ``max_distance`` bits from ``target``, closest first.
+    """
+    matches = []
+    for file_id, value in hashes.items():
+        distance = (target ^ value).bit_count()
+        if distance <= max_distance:
+            matches.append((file_id, distance))
+    matches.sort(key=lambda match: (match[1], match[0]))
+    return matches
+
+def _flip_masks(radius):
+    """Every block value at most ``radius`` bits from 0."""
+    masks = [0]
+    for count in range(1, radius + 1):
+        for positions in combinations(range(BLOCK_BITS), count):
+            masks.append(sum(1 << position for position in positions))
+    return masks
+
+def find_duplicate_groups(hashes, max_distance):
+    """
+    Group the ids of ``hashes`` (a dict of ids to integer hashes) linked by
+    hashes at most ``max_distance`` bits apart. Groups are transitive, so
+    the ends of a chain of near-duplicates may be further apart. Returns
+    groups of two or more sorted ids, largest groups first.
+    """
+    # Identical hashes are grouped first and compared once
+    ids_by_hash = defaultdict(list)
+    for file_id, value in hashes.items():
+        ids_by_hash[value].append(file_id)
+    values = list(ids_by_hash)
+
+    parents = list(range(len(values)))
+
+    def find(index):
+        while parents[index] != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+
+    masks = _flip_masks(max_distance // BLOCKS)
+    tables = [defaultdict(list) for _ in range(BLOCKS)]
+    for index, value in enumerate(values):
+        blocks = [(value >> (block * BLOCK_BITS)) & BLOCK_MASK for block in range(BLOCKS)]
+
+        # Hashes inserted before this one, sharing a block at the radius
+        candidates = set()
+        for table, block in zip(tables, blocks):
+            for bucket in map(table.get, [block ^ mask for mask in masks]):
+                if bucket:
+                    candidates.update(bucket)
+        for other in candidates:
+            if (value ^ values[other]).bit_count() <= max_distance:
+                parents[find(other)] = find(index)
+
+        for table, block in zip(tables, blocks):
+            table[block].append(index)
+
+    groups = defaultdict(list)
+    for index, value in enumerate(values):
+        groups[find(index)].extend(ids_by_hash[value])
+    return sorted(
+        (sorted(group) for group in groups.values() if len(group) > 1),
+        key=lambda group: (-len(group), group[0])
+    )
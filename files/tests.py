@@ -1,3 +1,1271 @@
-from django.test import TestCase
+from datetime import datetime, timedelta, timezone
+from io import StringIO
+from itertools import combinations
+from unittest import mock
+import random
+import boto3
+from botocore.config import Config
+from botocore.credentials import Credentials
+from botocore.stub import Stubber
+from django.db import DatabaseError
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadhandler import StopFutureHandlers
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone as django_timezone
+from django.utils.functional import empty
+from rest_framework import status
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import RefreshToken
+from user.models import User
+from files.models import BaseMediaFile, GenericFile, ImageFile, VideoFile, AudioFile, Tag, UploadSession, OutboxMessage, StoredContent, StorageUsage
+from files.search import index_file
+from files.similarity import find_duplicate_groups
+from files.upload_handlers import S3StreamingUploadHandler
+from files.views import FileViewSet
+from aws.s3_url_cache import PresignedURLCache
+from aws.s3_presigner import S3Presigner
+from aws import client as aws_client
+from aws.client import AssumedRoleCredentials
+from aws.sqs import send_json_objects
 
-# Create your tests here.
+class FakeAWSManager:
+    """
+    Stands in for AWSClientManager with static credentials, so the tests
+    never assume a role. Signing works offline; S3 and SQS calls are
+    patched by the tests that make them.
+    """
+    def __init__(self):
+        credentials = Credentials('AKIDTEST', 'secret', 'session-token')
+        self.s3_client = boto3.client(
+            's3',
+            aws_access_key_id=credentials.access_key,
+            aws_secret_access_key=credentials.secret_key,
+            aws_session_token=credentials.token,
+            region_name='us-east-1',
+            config=Config(signature_version='s3v4')
+        )
+        self.sqs_client = boto3.client(
+            'sqs',
+            aws_access_key_id=credentials.access_key,
+            aws_secret_access_key=credentials.secret_key,
+            aws_session_token=credentials.token,
+            region_name='us-east-1'
+        )
+        self.s3_presigner = S3Presigner(self.s3_client, settings.AWS_STORAGE_BUCKET_NAME, credentials)
+        self.s3_expiration = self.sqs_expiration = datetime.now(timezone.utc) + timedelta(hours=1)
+
+    def get_s3_client(self):
+        return self.s3_client
+
+    def get_s3_presigner(self):
+        return self.s3_presigner
+
+    def get_sqs_client(self):
+        return self.sqs_client
+
+def setUpModule():
+    # aws_manager is created on first use, from get_aws_manager
+    aws_client._manager = FakeAWSManager()
+
+def tearDownModule():
+    aws_client._manager = None
+    aws_client.aws_manager._wrapped = empty
+
+class FileTestMixin:
+    def authenticate(self):
+        """Create ``self.user`` and send its JWT with every request."""
+        self.user = User.objects.create_user(username='testuser', email='test@example.com', password='password')
+        refresh = RefreshToken.for_user(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {refresh.access_token}')
+
+    def indexed(self, file_instance):
+        index_file(file_instance)
+        return file_instance
+
+    def create_image(self, name, owner=None, **kwargs):
+        return self.indexed(ImageFile.objects.create(
+            name=name, size=100, mime_type='image/png', owner=owner or self.user,
+            width=10, height=10, color_depth=24, resolution='10x10', processed=True, **kwargs
+        ))
+
+    def create_video(self, name, owner=None, **kwargs):
+        kwargs.setdefault('renditions', [
+            {'resolution': resolution, 'key': f'processed/{resolution}.mp4', 'bit_rate': 1000, 'size': 100}
+            for resolution in ['480p', '720p', '1080p']
+        ])
+        return self.indexed(VideoFile.objects.create(
+            name=name, size=100, mime_type='video/mp4', owner=owner or self.user,
+            duration=10, resolution='1920x1080', frame_rate=30.0, video_codec='h264',
+            audio_codec='aac', bit_rate=1000, processed=True, **kwargs
+        ))
+
+    def create_audio(self, name, owner=None, **kwargs):
+        return self.indexed(AudioFile.objects.create(
+            name=name, size=100, mime_type='audio/mpeg', owner=owner or self.user,
+            duration=10, bit_rate=128, sample_rate=44100, channels=2, processed=True, **kwargs
+        ))
+
+    def create_generic(self, name, owner=None, **kwargs):
+        return self.indexed(GenericFile.objects.create(
+            name=name, size=100, mime_type='text/plain', owner=owner or self.user, **kwargs
+        ))
+
+class FileListTests(FileTestMixin, APITestCase):
+    def setUp(self):
+        self.authenticate()
+        self.other_user = User.objects.create_user(username='other', email='other@example.com', password='password')
+        self.url = reverse('file-list')
+
+        self.generic = self.create_generic('notes.txt')
+        self.image = self.create_image('photo.png', description='Beach trip')
+        self.video = self.create_video('clip.mp4', genre='Documentary')
+        self.audio = self.create_audio('song.mp3', genre='Jazz')
+        self.create_image('foreign.png', owner=self.other_user)
+
+    def ids(self, response):
+        return [item['id'] for item in response.data['results']]
+
+    def test_list_all_types_newest_first(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 4)
+        self.assertEqual(self.ids(response), [self.audio.id, self.video.id, self.image.id, self.generic.id])
+        self.assertIn('width', response.data['results'][2])
+
+    def test_list_filter_by_type(self):
+        response = self.client.get(self.url, {'type': 'image,audio'})
+        self.assertEqual(self.ids(response), [self.audio.id, self.image.id])
+
+    def test_list_search(self):
+        self.generic.tags.add(Tag.objects.create(name='Work'))
+        index_file(self.generic)
+
+        self.assertEqual(self.ids(self.client.get(self.url, {'search': 'beach'})), [self.image.id])
+        self.assertEqual(self.ids(self.client.get(self.url, {'search': 'jazz'})), [self.audio.id])
+        self.assertEqual(self.ids(self.client.get(self.url, {'search': 'work'})), [self.generic.id])
+
+    def test_list_search_ranks_name_matches_first(self):
+        named = self.create_generic('trip.txt')
+        self.assertEqual(self.ids(self.client.get(self.url, {'search': 'trip'})), [named.id, self.image.id])
+
+    def test_list_search_matches_word_prefixes(self):
+        self.assertEqual(self.ids(self.client.get(self.url, {'search': 'documen'})), [self.video.id])
+        self.assertEqual(self.ids(self.client.get(self.url, {'search': 'png'})), [self.image.id])
+        self.assertEqual(self.ids(self.client.get(self.url, {'search': 'photo'})), [self.image.id])
+
+    def test_list_search_only_returns_own_files(self):
+        self.assertEqual(self.ids(self.client.get(self.url, {'search': 'foreign'})), [])
+
+    def test_list_paginates_in_database(self):
+        response = self.client.get(self.url, {'page_size': 2, 'page': 2})
+        self.assertEqual(response.data['count'], 4)
+        self.assertEqual(self.ids(response), [self.image.id, self.generic.id])
+
+    def test_list_sparse_fieldset(self):
+        response = self.client.get(self.url, {'type': 'image', 'fields': 'id,name,thumbnail_url'})
+        self.assertEqual(set(response.data['results'][0]), {'id', 'name', 'thumbnail_url'})
+
+    def test_heavy_fields_are_opt_in(self):
+        response = self.client.get(self.url, {'type': 'image,video'})
+        video, image = response.data['results']
+        self.assertIn('url', image)
+        self.assertNotIn('exif_data', image)
+        self.assertNotIn('thumbnail_url', image)
+        self.assertNotIn('processed_video_urls', video)
+
+    def test_list_expand_adds_heavy_fields(self):
+        response = self.client.get(self.url, {'type': 'image,video', 'expand': 'exif_data,thumbnail_url'})
+        video, image = response.data['results']
+        self.assertIn('exif_data', image)
+        self.assertIn('thumbnail_url', image)
+        self.assertIn('url', image)
+        self.assertIn('thumbnail_url', video)
+        self.assertNotIn('processed_video_urls', video)
+
+    def test_detail_sparse_fieldset(self):
+        url = reverse('file-detail', args=[self.video.id])
+        response = self.client.get(url, {'fields': 'id', 'expand': 'processed_video_urls'})
+        self.assertEqual(set(response.data), {'id', 'processed_video_urls'})
+        self.assertEqual(set(response.data['processed_video_urls']), {'480p', '720p', '1080p'})
+
+    def test_only_produced_renditions_are_signed(self):
+        video = self.create_video('short.mp4', renditions=[
+            {'resolution': '720p', 'key': 'processed/720p.mp4', 'bit_rate': 2500, 'size': 50}
+        ])
+        response = self.client.get(reverse('file-detail', args=[video.id]), {'expand': 'processed_video_urls'})
+        self.assertEqual(list(response.data['processed_video_urls']), ['720p'])
+        self.assertIn(f'{video.storage_path}/processed/720p.mp4', response.data['processed_video_urls']['720p'])
+        self.assertEqual(len(video.get_storage_keys()), 3)
+
+MASTER_PLAYLIST = """#EXTM3U
+#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="aac",NAME="en",URI="audio/en.m3u8"
+#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=640x360,AUDIO="aac"
+360p/index.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=2500000,RESOLUTION=1280x720,AUDIO="aac"
+https://cdn.example.com/720p/index.m3u8
+"""
+
+VARIANT_PLAYLIST = """#EXTM3U
+#EXT-X-TARGETDURATION:6
+#EXT-X-MAP:URI="init.mp4"
+#EXTINF:6.0,
+segment0.m4s
+#EXTINF:6.0,
+segment1.m4s
+#EXTINF:6.0,
+../../../other/secret.m4s
+#EXT-X-ENDLIST
+"""
+
+class FilePlaylistTests(FileTestMixin, APITestCase):
+    def setUp(self):
+        self.authenticate()
+        self.video = self.create_video('clip.mp4', playlist='hls/master.m3u8')
+        self.url = reverse('file-playlist', args=[self.video.id])
+        self.playlists = {
+            f'{self.video.storage_path}/hls/master.m3u8': MASTER_PLAYLIST.encode(),
+            f'{self.video.storage_path}/hls/360p/index.m3u8': VARIANT_PLAYLIST.encode(),
+        }
+        cache.clear()
+
+    def get(self, *args, **kwargs):
+        with mock.patch('files.playlists.read_file', side_effect=self.playlists.__getitem__) as read_file:
+            response = self.client.get(*args, **kwargs)
+        return response, read_file
+
+    def test_master_playlist_points_variants_to_the_api(self):
+        response, _ = self.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/vnd.apple.mpegurl')
+        lines = response.content.decode().splitlines()
+        self.assertIn('URI="http://testserver/api/files/%d/playlist/?variant=hls%%2Faudio%%2Fen.m3u8"' % self.video.id, lines[1])
+        self.assertEqual(lines[3], 'http://testserver/api/files/%d/playlist/?variant=hls%%2F360p%%2Findex.m3u8' % self.video.id)
+        self.assertEqual(lines[5], 'https://cdn.example.com/720p/index.m3u8')
+
+    def test_variant_playlist_points_segments_to_the_api(self):
+        response, _ = self.get(self.url, {'variant': 'hls/360p/index.m3u8'})
+
+        lines = response.content.decode().splitlines()
+        base = 'http://testserver/api/files/%d/segment/?path=hls%%2F360p' % self.video.id
+        self.assertEqual(lines[2], f'#EXT-X-MAP:URI="{base}%2Finit.mp4"')
+        self.assertEqual(lines[4], f'{base}%2Fsegment0.m4s')
+        # URIs outside the video's objects are never signed
+        self.assertEqual(lines[8], '../../../other/secret.m4s')
+
+    def test_playlist_is_cached(self):
+        self.get(self.url)
+        response, read_file = self.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        read_file.assert_not_called()
+
+    def test_variant_outside_the_video_is_rejected(self):
+        response, _ = self.get(self.url, {'variant': '../other/index.m3u8'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_segment_redirects_to_a_signed_url(self):
+        url = reverse('file-segment', args=[self.video.id])
+        response = self.client.get(url, {'path': 'hls/360p/segment0.m4s'})
+
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertIn(f'/{self.video.storage_path}/hls/360p/segment0.m4s?', response['Location'])
+        self.assertIn('X-Amz-Signature=', response['Location'])
+
+        for path in ['../other/segment0.m4s', 'hls/360p/index.m3u8', '']:
+            self.assertEqual(self.client.get(url, {'path': path}).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_video_without_playlist(self):
+        video = self.create_video('other.mp4')
+        response, _ = self.get(reverse('file-playlist', args=[video.id]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+class FileSimilarityTests(FileTestMixin, APITestCase):
+    def setUp(self):
+        self.authenticate()
+
+        self.photo = self.create_image('photo.png', phash='ff00ff00ff00ff00')
+        self.resized = self.create_image('resized.png', phash='ff00ff00ff00ff03')
+        self.cropped = self.create_image('cropped.png', phash='ff00ff00ff00fff0')
+        self.other = self.create_image('other.png', phash='0123456789abcdef')
+        self.create_image('unhashed.png')
+        other_user = User.objects.create_user(username='other', email='other@example.com', password='password')
+        self.create_image('theirs.png', owner=other_user, phash='ff00ff00ff00ff00')
+
+    def test_similar_images_closest_first(self):
+        response = self.client.get(reverse('file-similar', args=[self.photo.id]), {'distance': 4})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [(item['id'], item['distance']) for item in response.data],
+            [(self.resized.id, 2), (self.cropped.id, 4)]
+        )
+
+    def test_similar_requires_a_hashed_image(self):
+        notes = self.create_generic('notes.txt')
+        response = self.client.get(reverse('file-similar', args=[notes.id]))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.get(reverse('file-similar', args=[self.photo.id]), {'distance': 64})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_library_duplicate_groups(self):
+        response = self.client.get(reverse('file-duplicates'), {'distance': 2})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['groups'], [[
+            {'id': self.photo.id, 'name': 'photo.png'},
+            {'id': self.resized.id, 'name': 'resized.png'},
+        ]])
+
+class DuplicateGroupTests(SimpleTestCase):
+    def test_groups_match_pairwise_comparison(self):
+        rng = random.Random(7)
+        hashes = {file_id: rng.getrandbits(64) for file_id in range(300)}
+        for file_id in range(300, 400):
+            value = hashes[file_id - 300]
+            for _ in range(rng.randint(0, 8)):
+                value ^= 1 << rng.randrange(64)
+            hashes[file_id] = value
+
+        for max_distance in (0, 3, 7):
+            groups = find_duplicate_groups(hashes, max_distance)
+            group_of = {file_id: index for index, group in enumerate(groups) for file_id in group}
+            for a, b in combinations(hashes, 2):
+                if (hashes[a] ^ hashes[b]).bit_count() <= max_distance:
+                    self.assertIn(a, group_of)
+                    self.assertEqual(group_of[a], group_of.get(b))
+
+class FileCursorPaginationTests(FileTestMixin, APITestCase):
+    def setUp(self):
+        self.authenticate()
+        self.url = reverse('file-list')
+        self.files = [self.create_generic(f'file{i}.txt') for i in range(5)]
+
+    def ids(self, response):
+        return [item['id'] for item in response.data['results']]
+
+    def test_cursor_walks_all_pages_without_count(self):
+        response = self.client.get(self.url, {'pagination': 'cursor', 'page_size': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('count', response.data)
+
+        seen = self.ids(response)
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            seen.extend(self.ids(response))
+
+        self.assertEqual(seen, [file.id for file in reversed(self.files)])
+
+    def test_cursor_pages_are_stable_during_uploads(self):
+        first = self.client.get(self.url, {'pagination': 'cursor', 'page_size': 2})
+        self.create_generic('late.txt')
+        second = self.client.get(first.data['next'])
+        self.assertEqual(self.ids(second), [self.files[2].id, self.files[1].id])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.url, {'cursor': 'garbage'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+class FileDetailTests(FileTestMixin, APITestCase):
+    def setUp(self):
+        self.authenticate()
+        self.other_user = User.objects.create_user(username='other', email='other@example.com', password='password')
+
+    def test_retrieve_resolves_subclass_in_one_query(self):
+        video = self.create_video('clip.mp4')
+        self.assertEqual(video.kind, 'video')
+
+        with self.assertNumQueries(1):
+            file_instance = BaseMediaFile.objects.with_subclasses().get(id=video.id).as_subclass()
+        self.assertIsInstance(file_instance, VideoFile)
+
+        response = self.client.get(reverse('file-detail', args=[video.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['video_codec'], 'h264')
+
+    def test_retrieve_other_users_file(self):
+        image = self.create_image('photo.png', owner=self.other_user)
+        response = self.client.get(reverse('file-detail', args=[image.id]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+class FileRenameTests(FileTestMixin, APITestCase):
+    def setUp(self):
+        self.authenticate()
+
+    def rename(self, file_instance, name):
+        return self.client.patch(
+            reverse('file-detail', args=[file_instance.id]),
+            {'name': name, 'description': 'renamed'},
+            format='json'
+        )
+
+    def test_rename_keeps_the_storage_key(self):
+        key = f'users/{self.user.user_id}/objects/' + '1' * 32
+        image = self.create_image('photo.png', storage_key=key)
+
+        response = self.rename(image, 'beach.png')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        image.refresh_from_db()
+        self.assertEqual((image.name, image.storage_key), ('beach.png', key))
+        self.assertIn(key, response.data['url'])
+
+    def test_update_does_not_restore_a_trashed_file(self):
+        image = self.create_image('photo.png')
+        trashed_at = django_timezone.now()
+        # Trashed by a concurrent request once the update has loaded the file
+        get_file = FileViewSet.get_file
+
+        def get_then_trash(view, pk):
+            file_instance = get_file(view, pk)
+            BaseMediaFile.objects.filter(id=image.id).update(deleted_at=trashed_at)
+            return file_instance
+
+        with mock.patch.object(FileViewSet, 'get_file', get_then_trash):
+            response = self.rename(image, 'beach.png')
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        image = BaseMediaFile.all_objects.get(id=image.id)
+        self.assertEqual((image.name, image.deleted_at), ('photo.png', trashed_at))
+
+    def test_rename_pins_the_legacy_key(self):
+        image = self.create_image('photo.png')
+        self.assertEqual(image.storage_path, f'users/{self.user.user_id}/files/photo.png')
+
+        self.rename(image, 'beach.png')
+
+        image.refresh_from_db()
+        self.assertEqual(image.name, 'beach.png')
+        self.assertEqual(image.storage_path, f'users/{self.user.user_id}/files/photo.png')
+
+    @mock.patch('files.management.commands.rekey_storage.delete_files', return_value=[])
+    @mock.patch('files.management.commands.rekey_storage.copy_file')
+    @mock.patch('files.management.commands.rekey_storage.list_all_files')
+    def test_rekey_storage(self, list_all_files, copy_file, delete_files):
+        image = self.create_image('photo.png')
+        old_path = image.storage_path
+        list_all_files.return_value = [
+            {'Key': old_path}, {'Key': f'{old_path}/thumbnail.png'}, {'Key': f'{old_path}.bak'}
+        ]
+
+        call_command('rekey_storage', stdout=StringIO())
+
+        image.refresh_from_db()
+        self.assertRegex(image.storage_key, rf'^users/{self.user.user_id}/objects/[0-9a-f]{{32}}$')
+        self.assertEqual(copy_file.call_args_list, [
+            mock.call(old_path, image.storage_key),
+            mock.call(f'{old_path}/thumbnail.png', f'{image.storage_key}/thumbnail.png'),
+        ])
+        delete_files.assert_called_once_with([old_path, f'{old_path}/thumbnail.png'])
+
+    def test_rekey_storage_follows_listing_pages(self):
+        clip = self.create_video('clip.mp4')
+        old_path = clip.storage_path
+        # Other names starting with this one fill the first page
+        pages = [
+            {'Contents': [{'Key': f'{old_path}{i}'} for i in range(1000)], 'IsTruncated': True},
+            {'Contents': [{'Key': old_path}, {'Key': f'{old_path}/thumbnail.png'}], 'IsTruncated': False},
+        ]
+
+        with mock.patch('aws.s3_objects.aws_manager') as manager, mock.patch.multiple(
+            'files.management.commands.rekey_storage', copy_file=mock.DEFAULT, delete_files=mock.DEFAULT
+        ) as s3:
+            manager.get_s3_client.return_value.get_paginator.return_value.paginate.return_value = pages
+            call_command('rekey_storage', stdout=StringIO())
+
+        clip.refresh_from_db()
+        self.assertEqual(
+            [c.args for c in s3['copy_file'].call_args_list],
+            [(old_path, clip.storage_key), (f'{old_path}/thumbnail.png', f'{clip.storage_key}/thumbnail.png')]
+        )
+        s3['delete_files'].assert_called_once_with([old_path, f'{old_path}/thumbnail.png'])
+
+class FileDeleteTests(FileTestMixin, APITestCase):
+    def setUp(self):
+        self.authenticate()
+
+    def test_destroy_moves_the_file_to_the_trash(self):
+        image = self.create_image('photo.png')
+        response = self.client.delete(reverse('file-detail', args=[image.id]))
+
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.client.get(reverse('file-list')).data['count'], 0)
+        self.assertEqual(self.client.get(reverse('file-detail', args=[image.id])).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get(reverse('file-list'), {'search': 'photo'}).data['count'], 0)
+
+        response = self.client.post(reverse('file-restore', args=[image.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['id'], image.id)
+        self.assertEqual(self.client.get(reverse('file-list')).data['count'], 1)
+
+    def test_trashed_file_releases_its_name(self):
+        image = self.create_image('photo.png', deleted_at=django_timezone.now())
+        response = self.client.post(reverse('file-start-upload'), {'name': image.name, 'size': 10}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        self.create_image('photo.png')
+        response = self.client.post(reverse('file-restore', args=[image.id]))
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+    def test_bulk_delete(self):
+        other_user = User.objects.create_user(username='other', email='other@example.com', password='password')
+        image = self.create_image('photo.png')
+        audio = self.create_audio('song.mp3')
+        pending = self.create_generic('pending.txt', processed=False)
+        foreign = self.create_generic('foreign.txt', owner=other_user, processed=True)
+
+        response = self.client.post(
+            reverse('file-bulk-delete'),
+            {'ids': [image.id, audio.id, pending.id, foreign.id]},
+            format='json'
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['deleted'], sorted([image.id, audio.id]))
+        self.assertEqual(response.data['processing'], [pending.id])
+        self.assertEqual(response.data['not_found'], [foreign.id])
+        self.assertEqual(
+            sorted(BaseMediaFile.objects.values_list('id', flat=True)),
+            sorted([pending.id, foreign.id])
+        )
+        self.assertEqual(BaseMediaFile.all_objects.count(), 4)
+
+    @mock.patch('files.management.commands.purge_deleted_files.delete_files', return_value=[])
+    def test_purge_deletes_expired_files_and_their_objects(self, delete_files):
+        expired = self.create_video('clip.mp4', deleted_at=django_timezone.now() - timedelta(days=31))
+        recent = self.create_image('photo.png', deleted_at=django_timezone.now() - timedelta(days=1))
+
+        call_command('purge_deleted_files', stdout=StringIO())
+
+        delete_files.assert_called_once()
+        self.assertEqual(sorted(delete_files.call_args.args[0]), sorted(expired.get_storage_keys()))
+        self.assertEqual(len(expired.get_storage_keys()), 5)
+        self.assertEqual(list(BaseMediaFile.all_objects.values_list('id', flat=True)), [recent.id])
+
+    @mock.patch('files.management.commands.purge_deleted_files.delete_files', return_value=[])
+    def test_purge_keeps_objects_shared_with_other_files(self, delete_files):
+        key = 'users/1/objects/a'
+        StoredContent.objects.create(owner=self.user, sha256='0' * 64, storage_key=key, size=100, ref_count=2)
+        expired = django_timezone.now() - timedelta(days=31)
+        first = self.create_generic('notes.txt', storage_key=key, content_hash='0' * 64, deleted_at=expired)
+        copy = self.create_generic('copy.txt', storage_key=key, content_hash='0' * 64)
+
+        call_command('purge_deleted_files', stdout=StringIO())
+
+        delete_files.assert_not_called()
+        self.assertEqual(StoredContent.objects.get().ref_count, 1)
+        self.assertFalse(BaseMediaFile.all_objects.filter(id=first.id).exists())
+
+        BaseMediaFile.objects.filter(id=copy.id).update(deleted_at=expired)
+        call_command('purge_deleted_files', stdout=StringIO())
+
+        delete_files.assert_called_once()
+        self.assertEqual(delete_files.call_args.args[0], [key])
+        self.assertFalse(StoredContent.objects.exists())
+        self.assertFalse(BaseMediaFile.all_objects.exists())
+
+class FileQueryBudgetTests(FileTestMixin, APITestCase):
+    def setUp(self):
+        self.authenticate()
+        self.url = reverse('file-list')
+
+        tag = Tag.objects.create(name='holiday')
+        creators = [self.create_generic, self.create_image, self.create_video, self.create_audio]
+        for i in range(100):
+            file_instance = creators[i % 4](f'file{i}')
+            file_instance.tags.add(tag)
+
+    def test_list_page_runs_constant_number_of_queries(self):
+        # user, count, page with joined child tables, prefetched tags
+        with self.assertNumQueries(4):
+            response = self.client.get(self.url, {'page_size': 100})
+        self.assertEqual(len(response.data['results']), 100)
+        self.assertEqual(response.data['results'][0]['tags'], ['holiday'])
+
+@override_settings(WEBHOOK_SECRET='webhook-secret')
+class WebhookTests(FileTestMixin, APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', email='test@example.com', password='password')
+        self.url = reverse('webhook')
+        self.client.credentials(HTTP_X_WEBHOOK_SECRET='webhook-secret')
+
+    def test_requests_without_the_secret_are_rejected(self):
+        clip = self.create_generic('clip.mp3', processed=False)
+        result = {'file_id': str(clip.id), 'mime_type': 'text/plain', 'data': {}}
+
+        self.client.credentials(HTTP_X_WEBHOOK_SECRET='wrong')
+        self.assertEqual(self.client.post(self.url, result, format='json').status_code, status.HTTP_403_FORBIDDEN)
+        self.client.credentials()
+        self.assertEqual(self.client.post(self.url, result, format='json').status_code, status.HTTP_403_FORBIDDEN)
+        self.assertFalse(BaseMediaFile.objects.get(id=clip.id).processed)
+
+    def test_promotion_keeps_the_file_and_its_tags(self):
+        clip = self.create_generic('clip.mp3', processed=False)
+        clip.tags.add(Tag.objects.create(name='podcast'))
+        result = {'file_id': clip.id, 'mime_type': 'audio/mpeg', 'data': {
+            'duration': 60, 'bit_rate': 128, 'sample_rate': 44100, 'channels': 2
+        }}
+
+        response = self.client.post(self.url, result, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['id'], clip.id)
+        self.assertEqual(response.data['tags'], [{'id': clip.tags.get().id, 'name': 'podcast'}])
+        audio = AudioFile.objects.get(id=clip.id)
+        self.assertEqual(audio.upload_date, clip.upload_date)
+        self.assertFalse(GenericFile.objects.filter(id=clip.id).exists())
+
+        response = self.client.post(self.url, result, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_unknown_file(self):
+        response = self.client.post(self.url, {'file_id': 999999, 'mime_type': 'image/png', 'data': {}}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_image_perceptual_hash(self):
+        photo = self.create_generic('photo.png', processed=False)
+        data = {'width': 10, 'height': 10, 'color_depth': 24, 'resolution': '10x10'}
+
+        response = self.client.post(self.url, {'file_id': photo.id, 'mime_type': 'image/png', 'data': {
+            **data, 'phash': 'not-a-hash'
+        }}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post(self.url, {'file_id': photo.id, 'mime_type': 'image/png', 'data': {
+            **data, 'phash': 'FFD8A0C3E1000000'
+        }}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(ImageFile.objects.get(id=photo.id).phash, 'ffd8a0c3e1000000')
+
+    def test_files_sharing_the_content_are_promoted_together(self):
+        first = self.create_generic('photo.png', processed=False, storage_key='users/1/objects/a', content_hash='0' * 64)
+        copy = self.create_generic('copy.png', processed=False, storage_key='users/1/objects/a', content_hash='0' * 64)
+
+        response = self.client.post(self.url, {'file_id': first.id, 'mime_type': 'image/png', 'data': {
+            'width': 10, 'height': 10, 'color_depth': 24, 'resolution': '10x10'
+        }}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            set(ImageFile.objects.filter(processed=True).values_list('id', flat=True)), {first.id, copy.id}
+        )
+        self.assertEqual(ImageFile.objects.get(id=copy.id).name, 'copy.png')
+
+@override_settings(WEBHOOK_SECRET='webhook-secret')
+class BulkWebhookTests(FileTestMixin, APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', email='test@example.com', password='password')
+        self.url = reverse('webhook-bulk')
+        self.client.credentials(HTTP_X_WEBHOOK_SECRET='webhook-secret')
+
+    def test_requests_without_the_secret_are_rejected(self):
+        notes = self.create_generic('notes.txt', processed=False)
+        results = [{'file_id': notes.id, 'mime_type': 'text/plain', 'data': {}}]
+
+        self.client.credentials()
+        self.assertEqual(self.client.post(self.url, results, format='json').status_code, status.HTTP_403_FORBIDDEN)
+        with override_settings(WEBHOOK_SECRET=None):
+            self.assertEqual(self.client.post(self.url, results, format='json').status_code, status.HTTP_403_FORBIDDEN)
+        self.assertFalse(BaseMediaFile.objects.get(id=notes.id).processed)
+
+    def test_numeric_string_ids_are_accepted(self):
+        notes = self.create_generic('notes.txt', processed=False)
+        response = self.client.post(self.url, [{'file_id': str(notes.id), 'mime_type': 'text/plain', 'data': {}}], format='json')
+
+        self.assertEqual(response.data['results'], [{'file_id': notes.id, 'status': 'processed'}])
+
+    def test_results_are_applied_in_place(self):
+        photo = self.create_generic('photo.png', processed=False)
+        photo.tags.add(Tag.objects.create(name='beach'))
+        clip = self.create_generic('clip.mp4', processed=False)
+        notes = self.create_generic('notes.txt', processed=False)
+
+        response = self.client.post(self.url, [
+            {'file_id': photo.id, 'mime_type': 'image/png', 'data': {
+                'width': 10, 'height': 20, 'color_depth': 24, 'resolution': '10x20'
+            }},
+            {'file_id': clip.id, 'mime_type': 'video/mp4', 'data': {
+                'duration': 5, 'resolution': '1920x1080', 'frame_rate': 30.0,
+                'video_codec': 'h264', 'audio_codec': 'aac', 'bit_rate': 1000
+            }},
+            {'file_id': notes.id, 'mime_type': 'text/plain', 'data': {}},
+            {'file_id': photo.id, 'mime_type': 'image/png', 'data': {}},
+            {'file_id': 999999, 'mime_type': 'image/png', 'data': {}},
+        ], format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [item['status'] for item in response.data['results']],
+            ['processed', 'processed', 'processed', 'duplicate', 'not_found']
+        )
+        image = ImageFile.objects.get(id=photo.id)
+        self.assertEqual((image.width, image.height, image.kind), (10, 20, 'image'))
+        self.assertEqual([tag.name for tag in image.tags.all()], ['beach'])
+        self.assertFalse(GenericFile.objects.filter(id__in=[photo.id, clip.id]).exists())
+        self.assertTrue(VideoFile.objects.filter(id=clip.id, processed=True).exists())
+        self.assertTrue(GenericFile.objects.get(id=notes.id).processed)
+
+    def test_video_rendition_manifest(self):
+        clip = self.create_generic('clip.mov', processed=False)
+        video_data = {
+            'duration': 5, 'resolution': '1280x720', 'frame_rate': 30.0,
+            'video_codec': 'h264', 'audio_codec': 'aac', 'bit_rate': 1000,
+        }
+
+        response = self.client.post(self.url, [
+            {'file_id': clip.id, 'mime_type': 'video/quicktime', 'data': {**video_data, 'renditions': [
+                {'resolution': '480p', 'key': f'{clip.storage_path}/processed/480p.mp4', 'bit_rate': 800, 'size': 10},
+                {'resolution': '720p', 'key': 'processed/720p.mp4', 'bit_rate': 2500, 'size': 30},
+            ], 'playlist': f'{clip.storage_path}/hls/master.m3u8'}},
+        ], format='json')
+
+        self.assertEqual(response.data['results'][0]['status'], 'processed')
+        video = VideoFile.objects.get(id=clip.id)
+        self.assertEqual(video.get_rendition_keys(), {
+            '480p': f'{clip.storage_path}/processed/480p.mp4',
+            '720p': f'{clip.storage_path}/processed/720p.mp4',
+        })
+        self.assertEqual(video.playlist, 'hls/master.m3u8')
+        self.assertEqual(video.get_storage_prefixes(), [f'{clip.storage_path}/hls/'])
+
+    def test_rendition_keys_stay_under_the_file(self):
+        clip = self.create_generic('clip.mov', processed=False)
+        response = self.client.post(self.url, [
+            {'file_id': clip.id, 'mime_type': 'video/mp4', 'data': {
+                'duration': 5, 'resolution': '1280x720', 'frame_rate': 30.0,
+                'video_codec': 'h264', 'audio_codec': 'aac', 'bit_rate': 1000,
+                'renditions': [{'resolution': '720p', 'key': '../../other/file.mp4'}],
+            }},
+        ], format='json')
+        self.assertEqual(response.data['results'][0]['status'], 'invalid')
+
+    def test_retry_is_idempotent(self):
+        photo = self.create_generic('photo.png', processed=False)
+        result = {'file_id': photo.id, 'mime_type': 'image/png', 'data': {
+            'width': 10, 'height': 20, 'color_depth': 24, 'resolution': '10x20'
+        }}
+        self.client.post(self.url, [result], format='json')
+        response = self.client.post(self.url, [result], format='json')
+
+        self.assertEqual(response.data['results'], [{'file_id': photo.id, 'status': 'already_processed'}])
+        self.assertEqual(ImageFile.objects.count(), 1)
+
+    def test_invalid_result_does_not_block_the_batch(self):
+        photo = self.create_generic('photo.png', processed=False)
+        notes = self.create_generic('notes.txt', processed=False)
+
+        response = self.client.post(self.url, [
+            {'file_id': photo.id, 'mime_type': 'image/png', 'data': {'width': 10}},
+            {'file_id': notes.id, 'mime_type': 'text/plain'},
+        ], format='json')
+
+        self.assertEqual([item['status'] for item in response.data['results']], ['invalid', 'processed'])
+        self.assertFalse(BaseMediaFile.objects.get(id=photo.id).processed)
+        self.assertEqual(BaseMediaFile.objects.get(id=photo.id).kind, 'generic')
+
+class PresignedURLCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = PresignedURLCache(max_size=2, reuse_fraction=0.5, clock=lambda: self.now)
+
+    def test_reuses_url_until_fraction_of_lifetime(self):
+        self.cache.set(('a', 3600), 'url-a', 3600)
+        self.now += 1799
+        self.assertEqual(self.cache.get(('a', 3600)), 'url-a')
+        self.now += 1
+        self.assertIsNone(self.cache.get(('a', 3600)))
+
+    def test_evicts_least_recently_used(self):
+        self.cache.set(('a', 3600), 'url-a', 3600)
+        self.cache.set(('b', 3600), 'url-b', 3600)
+        self.cache.get(('a', 3600))
+        self.cache.set(('c', 3600), 'url-c', 3600)
+        self.assertEqual(self.cache.get(('a', 3600)), 'url-a')
+        self.assertIsNone(self.cache.get(('b', 3600)))
+        self.assertEqual(len(self.cache), 2)
+
+    def test_does_not_cache_expired_lifetime(self):
+        self.cache.set(('a', 3600), 'url-a', 0)
+        self.assertIsNone(self.cache.get(('a', 3600)))
+
+class S3PresignerTests(SimpleTestCase):
+    def test_urls_match_botocore(self):
+        now = datetime(2024, 8, 1, 12, 30, 15)
+        keys = ['users/1/files/a b+c/ção~.png', 'users/1/files/x!*()&=;:,?#%.txt/thumbnail.png']
+
+        for bucket in ['simplebox-test', 'simplebox.dotted']:
+            s3_client = boto3.client(
+                's3',
+                aws_access_key_id='AKIDEXAMPLE',
+                aws_secret_access_key='secret',
+                aws_session_token='token/+=',
+                region_name='sa-east-1',
+                config=Config(signature_version='s3v4')
+            )
+            presigner = S3Presigner(s3_client, bucket, Credentials('AKIDEXAMPLE', 'secret', 'token/+='))
+            urls = presigner.presign_many(keys, 3600, now=now.replace(tzinfo=timezone.utc))
+
+            with mock.patch('botocore.auth.datetime') as botocore_datetime:
+                botocore_datetime.datetime.utcnow.return_value = now
+                for key in keys:
+                    expected = s3_client.generate_presigned_url(
+                        'get_object', Params={'Bucket': bucket, 'Key': key}, ExpiresIn=3600
+                    )
+                    self.assertEqual(urls[key], expected)
+
+class FakeSTSClient:
+    def __init__(self, lifetimes):
+        self.lifetimes = list(lifetimes)
+        self.calls = 0
+
+    def assume_role(self, RoleArn, RoleSessionName):
+        self.calls += 1
+        return {'Credentials': {
+            'AccessKeyId': f'AKID{self.calls}',
+            'SecretAccessKey': 'secret',
+            'SessionToken': 'token',
+            'Expiration': datetime.now(timezone.utc) + self.lifetimes.pop(0),
+        }}
+
+class AssumedRoleCredentialsTests(SimpleTestCase):
+    def test_refresh_uses_prefetched_credentials(self):
+        sts_client = FakeSTSClient([timedelta(minutes=12), timedelta(hours=1)])
+        role = AssumedRoleCredentials(sts_client, 'arn:aws:iam::1:role/Test', 'Test')
+        self.assertTrue(role.needs_prefetch())
+
+        role.prefetch()
+        self.assertFalse(role.needs_prefetch())
+        self.assertEqual(sts_client.calls, 2)
+
+        # botocore refreshes inside its advisory window without calling STS
+        self.assertEqual(role.credentials.get_frozen_credentials().access_key, 'AKID2')
+        self.assertEqual(sts_client.calls, 2)
+        self.assertFalse(role.needs_prefetch())
+
+    def test_stale_prefetched_credentials_are_not_used(self):
+        # Prefetched, then left unused until they are about to expire too
+        sts_client = FakeSTSClient([timedelta(minutes=12), timedelta(minutes=14), timedelta(hours=1)])
+        role = AssumedRoleCredentials(sts_client, 'arn:aws:iam::1:role/Test', 'Test')
+        role.prefetch()
+        self.assertTrue(role.needs_prefetch())
+
+        self.assertEqual(role.credentials.get_frozen_credentials().access_key, 'AKID3')
+        self.assertEqual(sts_client.calls, 3)
+        self.assertFalse(role.needs_prefetch())
+
+    def test_fresh_credentials_do_not_need_prefetch(self):
+        role = AssumedRoleCredentials(FakeSTSClient([timedelta(hours=1)]), 'arn:aws:iam::1:role/Test', 'Test')
+        self.assertFalse(role.needs_prefetch())
+
+class FakeSQSClient:
+    def __init__(self, fail_ids=()):
+        self.fail_ids = set(fail_ids)
+        self.batches = []
+        self.messages = []
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.batches.append([entry['MessageBody'] for entry in Entries])
+        return {'Failed': [
+            {'Id': entry['Id'], 'SenderFault': False, 'Code': 'InternalError', 'Message': 'Try again'}
+            for entry in Entries if entry['MessageBody'] in self.fail_ids
+        ]}
+
+    def send_message(self, QueueUrl, MessageBody, MessageAttributes):
+        self.messages.append(MessageBody)
+        return {'MessageId': MessageBody}
+
+@override_settings(AWS_SQS_QUEUE_URL='queue')
+class SendJSONObjectsTests(SimpleTestCase):
+    def send(self, client, dictionaries):
+        with mock.patch('aws.sqs.aws_manager') as manager:
+            manager.get_sqs_client.return_value = client
+            return send_json_objects(dictionaries)
+
+    def test_objects_are_sent_in_batches_of_ten(self):
+        client = FakeSQSClient()
+        self.assertEqual(self.send(client, list(range(25))), {})
+
+        self.assertEqual([len(batch) for batch in client.batches], [10, 10, 5])
+        self.assertEqual(sum(client.batches, []), [str(i) for i in range(25)])
+
+    def test_batch_is_limited_by_size(self):
+        client = FakeSQSClient()
+        self.send(client, ['x' * (100 * 1024)] * 3)
+
+        self.assertEqual([len(batch) for batch in client.batches], [2, 1])
+
+    def test_failed_entries_are_reported(self):
+        client = FakeSQSClient(fail_ids={'1'})
+        self.assertEqual(self.send(client, [0, 1, 2]), {1: 'InternalError: Try again'})
+        self.assertEqual(client.messages, [])
+
+    def test_failed_calls_are_reported(self):
+        client = mock.Mock()
+        client.send_message_batch.side_effect = ConnectionError('connection reset')
+        self.assertEqual(self.send(client, [0, 1]), {
+            0: 'ConnectionError: connection reset', 1: 'ConnectionError: connection reset'
+        })
+
+class OutboxDispatchTests(TestCase):
+    def test_sent_jobs_are_deleted_and_failed_jobs_backed_off(self):
+        first = OutboxMessage.objects.create(payload={'file_id': 1})
+        second = OutboxMessage.objects.create(payload={'file_id': 2})
+
+        with mock.patch('files.management.commands.dispatch_outbox.send_json_objects', return_value={1: 'InternalError: Try again'}) as send:
+            call_command('dispatch_outbox', '--once', stdout=StringIO())
+
+        send.assert_called_once_with([{'file_id': 1}, {'file_id': 2}])
+        self.assertFalse(OutboxMessage.objects.filter(id=first.id).exists())
+        second.refresh_from_db()
+        self.assertEqual(second.attempts, 1)
+        self.assertEqual(second.last_error, 'InternalError: Try again')
+        self.assertGreater(second.next_attempt_at, second.created_at)
+
+    def test_jobs_are_not_sent_before_their_next_attempt(self):
+        OutboxMessage.objects.create(payload={'file_id': 1}, next_attempt_at=django_timezone.now() + timedelta(minutes=1))
+
+        with mock.patch('files.management.commands.dispatch_outbox.send_json_objects') as send:
+            call_command('dispatch_outbox', '--once', stdout=StringIO())
+
+        send.assert_not_called()
+        self.assertEqual(OutboxMessage.objects.count(), 1)
+
+class DirectUploadTests(FileTestMixin, APITestCase):
+    def setUp(self):
+        self.authenticate()
+        self.url = reverse('file-start-upload')
+
+    def test_start_small_upload_returns_presigned_post(self):
+        response = self.client.post(self.url, {'name': 'photo.png', 'size': 1024}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['upload_type'], 'post')
+        self.assertRegex(response.data['key'], rf'^users/{self.user.user_id}/objects/[0-9a-f]{{32}}$')
+        self.assertEqual(response.data['fields']['key'], response.data['key'])
+
+    def test_complete_upload_rejects_foreign_keys(self):
+        response = self.client.post(
+            reverse('file-complete-upload'),
+            {'name': 'photo.png', 'key': 'users/999/objects/' + '0' * 32},
+            format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_complete_upload_rejects_keys_in_use(self):
+        image = self.create_image('photo.png', storage_key=f'users/{self.user.user_id}/objects/' + '0' * 32)
+        response = self.client.post(
+            reverse('file-complete-upload'),
+            {'name': 'other.png', 'key': image.storage_key},
+            format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+    def test_start_upload_name_conflict(self):
+        self.create_generic('photo.png')
+        response = self.client.post(self.url, {'name': 'photo.png', 'size': 1024}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+    def test_start_upload_requires_size(self):
+        response = self.client.post(self.url, {'name': 'photo.png'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_start_upload_rejects_files_s3_cannot_store(self):
+        response = self.client.post(self.url, {'name': 'disk.img', 'size': 5 * 1024 ** 4 + 1}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(UPLOAD_PART_URLS_PER_REQUEST=100)
+    @mock.patch('files.views.create_multipart_upload', return_value='upload-id')
+    def test_multipart_part_urls_are_signed_in_pages(self, create_upload):
+        response = self.client.post(self.url, {'name': 'disk.img', 'size': 1024 ** 4}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['part_count'], 10000)
+        self.assertEqual([part['part_number'] for part in response.data['parts']], list(range(1, 101)))
+
+        parts_url = reverse('file-upload-parts')
+        key = response.data['key']
+        response = self.client.post(parts_url, {'key': key, 'upload_id': 'upload-id', 'from': 9950}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([part['part_number'] for part in response.data['parts']], list(range(9950, 10001)))
+        self.assertIn('partNumber=9950', response.data['parts'][0]['url'])
+
+        response = self.client.post(parts_url, {'key': key, 'upload_id': 'upload-id', 'from': 1, 'to': 101}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(
+            parts_url, {'key': 'users/999/objects/' + '0' * 32, 'upload_id': 'upload-id'}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+class StreamingUploadTests(FileTestMixin, APITestCase):
+    def setUp(self):
+        self.authenticate()
+
+    def test_name_conflict_is_rejected_before_upload(self):
+        self.create_generic('notes.txt')
+        with mock.patch('files.upload_handlers.create_multipart_upload') as create_upload:
+            response = self.client.post(
+                reverse('file-list'),
+                {'file': SimpleUploadedFile('notes.txt', b'hello')},
+                format='multipart'
+            )
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        create_upload.assert_not_called()
+
+    @override_settings(UPLOAD_STREAM_PART_SIZE=5 * 1024 * 1024)
+    def test_handler_uploads_in_parts(self):
+        handler = S3StreamingUploadHandler(None, lambda name: f'key/{name}')
+        chunk = b'x' * (3 * 1024 * 1024)
+        with mock.patch.multiple(
+            'files.upload_handlers',
+            create_multipart_upload=mock.DEFAULT,
+            upload_part=mock.DEFAULT,
+            complete_multipart_upload=mock.DEFAULT
+        ) as s3:
+            s3['create_multipart_upload'].return_value = 'upload-id'
+            s3['upload_part'].side_effect = lambda key, upload_id, number, body: f'etag-{number}'
+            with self.assertRaises(StopFutureHandlers):
+                handler.new_file('file', 'big.bin', 'application/octet-stream', None)
+            for start in range(0, 4 * len(chunk), len(chunk)):
+                self.assertIsNone(handler.receive_data_chunk(chunk, start))
+            uploaded_file = handler.file_complete(4 * len(chunk))
+
+        self.assertEqual([c.args[2] for c in s3['upload_part'].call_args_list], [1, 2])
+        self.assertEqual([len(c.args[3]) for c in s3['upload_part'].call_args_list], [2 * len(chunk), 2 * len(chunk)])
+        s3['complete_multipart_upload'].assert_called_once_with(
+            'key/big.bin', 'upload-id', [(1, 'etag-1'), (2, 'etag-2')]
+        )
+        self.assertEqual(uploaded_file.key, 'key/big.bin')
+        self.assertEqual(uploaded_file.size, 4 * len(chunk))
+
+    @override_settings(UPLOAD_STREAM_PART_SIZE=5 * 1024 * 1024)
+    def test_handler_aborts_unfinished_upload(self):
+        handler = S3StreamingUploadHandler(None, lambda name: f'key/{name}')
+        with mock.patch.multiple(
+            'files.upload_handlers',
+            create_multipart_upload=mock.DEFAULT,
+            upload_part=mock.DEFAULT,
+            abort_multipart_upload=mock.DEFAULT
+        ) as s3:
+            s3['create_multipart_upload'].return_value = 'upload-id'
+            with self.assertRaises(StopFutureHandlers):
+                handler.new_file('file', 'big.bin', 'application/octet-stream', None)
+            handler.receive_data_chunk(b'x' * (5 * 1024 * 1024), 0)
+            # Another handler raised StopUpload: the file is never completed
+            handler.upload_complete()
+
+        s3['abort_multipart_upload'].assert_called_once_with('key/big.bin', 'upload-id')
+
+    @override_settings(UPLOAD_STREAM_PART_SIZE=5 * 1024 * 1024)
+    def test_failed_request_aborts_upload(self):
+        content = b'x' * (6 * 1024 * 1024)
+        with mock.patch.multiple(
+            'files.upload_handlers',
+            create_multipart_upload=mock.DEFAULT,
+            upload_part=mock.DEFAULT,
+            abort_multipart_upload=mock.DEFAULT
+        ) as s3:
+            s3['create_multipart_upload'].return_value = 'upload-id'
+            s3['upload_part'].side_effect = ConnectionError
+            with self.assertRaises(ConnectionError):
+                self.client.post(
+                    reverse('file-list'), {'file': SimpleUploadedFile('big.bin', content)}, format='multipart'
+                )
+
+        key = s3['create_multipart_upload'].call_args.args[0]
+        s3['abort_multipart_upload'].assert_called_once_with(key, 'upload-id')
+        self.assertFalse(BaseMediaFile.all_objects.exists())
+
+    @mock.patch('files.upload_handlers.upload_file')
+    def test_duplicate_of_purged_content_is_rejected(self, upload_file):
+        # The stored copy is purged between the handler's lookup and the registration
+        with mock.patch('files.views.find_stored_content', return_value=f'users/{self.user.user_id}/objects/gone'):
+            response = self.client.post(
+                reverse('file-list'), {'file': SimpleUploadedFile('photo.png', b'pixels')}, format='multipart'
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        upload_file.assert_not_called()
+        self.assertFalse(BaseMediaFile.all_objects.exists())
+        self.assertFalse(StoredContent.objects.exists())
+        self.assertFalse(OutboxMessage.objects.exists())
+
+    @mock.patch('files.upload_handlers.upload_file')
+    def test_duplicate_content_is_stored_once(self, upload_file):
+        response = self.client.post(
+            reverse('file-list'), {'file': SimpleUploadedFile('photo.png', b'pixels')}, format='multipart'
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        first = BaseMediaFile.objects.get(name='photo.png')
+        BaseMediaFile.objects.filter(id=first.id).update(processed=True, mime_type='image/png')
+
+        response = self.client.post(
+            reverse('file-list'), {'file': SimpleUploadedFile('copy.png', b'pixels')}, format='multipart'
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        upload_file.assert_called_once()
+        copy = BaseMediaFile.objects.get(name='copy.png')
+        self.assertEqual(copy.storage_key, first.storage_key)
+        self.assertTrue(copy.processed)
+        self.assertEqual(copy.mime_type, 'image/png')
+        self.assertEqual(OutboxMessage.objects.count(), 1)
+        self.assertEqual(StoredContent.objects.get().ref_count, 2)
+
+class StorageUsageTests(FileTestMixin, APITestCase):
+    def setUp(self):
+        self.authenticate()
+
+    def get_usage(self):
+        usage = StorageUsage.objects.get(user=self.user)
+        return {kind: (getattr(usage, f'{kind}_files'), getattr(usage, f'{kind}_bytes')) for kind in ['generic', 'image']}
+
+    @mock.patch('files.upload_handlers.upload_file')
+    def test_usage_follows_the_files(self, upload_file):
+        response = self.client.post(
+            reverse('file-list'), {'file': SimpleUploadedFile('photo.png', b'pixels')}, format='multipart'
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        photo = BaseMediaFile.objects.get(name='photo.png')
+        self.assertEqual(self.get_usage(), {'generic': (1, 6), 'image': (0, 0)})
+
+        with override_settings(WEBHOOK_SECRET='webhook-secret'):
+            response = self.client.post(reverse('webhook'), {'file_id': photo.id, 'mime_type': 'image/png', 'data': {
+                'width': 10, 'height': 10, 'color_depth': 24, 'resolution': '10x10'
+            }}, format='json', HTTP_X_WEBHOOK_SECRET='webhook-secret')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.get_usage(), {'generic': (0, 0), 'image': (1, 6)})
+
+        self.assertEqual(self.client.delete(reverse('file-detail', args=[photo.id])).status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.client.delete(reverse('file-detail', args=[photo.id])).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.get_usage(), {'generic': (0, 0), 'image': (0, 0)})
+
+        response = self.client.post(reverse('file-restore', args=[photo.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.get_usage(), {'generic': (0, 0), 'image': (1, 6)})
+
+        response = self.client.post(reverse('file-bulk-delete'), {'ids': [photo.id]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.get_usage(), {'generic': (0, 0), 'image': (0, 0)})
+
+    def test_reconcile_repairs_drift(self):
+        self.create_image('photo.png')
+        self.create_generic('notes.txt')
+        self.create_generic('old.txt', deleted_at=django_timezone.now())
+        StorageUsage.objects.create(user=self.user, generic_files=5, audio_bytes=-100)
+
+        out = StringIO()
+        call_command('reconcile_storage_usage', stdout=out)
+
+        self.assertIn('Repaired the storage usage of 1 users.', out.getvalue())
+        self.assertEqual(self.get_usage(), {'generic': (1, 100), 'image': (1, 100)})
+        self.assertEqual(StorageUsage.objects.get(user=self.user).audio_bytes, 0)
+
+class UploadSessionTests(FileTestMixin, APITestCase):
+    def setUp(self):
+        self.authenticate()
+
+    def test_part_count(self):
+        session = UploadSession(size=10 * 1024 * 1024 + 1, part_size=5 * 1024 * 1024)
+        self.assertEqual(session.part_count, 3)
+        self.assertEqual(UploadSession(size=0, part_size=5 * 1024 * 1024).part_count, 1)
+
+    def test_create_requires_size(self):
+        response = self.client.post(reverse('upload-session-list'), {'name': 'video.mp4'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_complete_large_upload(self):
+        size = 3 * 1024 ** 3
+        session = UploadSession.objects.create(
+            owner=self.user, name='video.mp4', size=size, part_size=1024 ** 3, upload_id='x'
+        )
+        parts = [{'PartNumber': number, 'ETag': f'etag-{number}', 'Size': 1024 ** 3} for number in range(1, 4)]
+        url = reverse('upload-session-complete', args=[session.id])
+
+        with Stubber(aws_client._manager.s3_client) as s3:
+            s3.add_response('list_parts', {'Parts': parts[:2]})
+            response = self.client.post(url)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(response.data['missing_parts'], [3])
+
+            s3.add_response('list_parts', {'Parts': parts})
+            s3.add_response('complete_multipart_upload', {})
+            s3.add_response('head_object', {'ContentLength': size})
+            response = self.client.post(url)
+            s3.assert_no_pending_responses()
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(BaseMediaFile.objects.get(name='video.mp4').size, size)
+        self.assertFalse(UploadSession.objects.filter(id=session.id).exists())
+
+    def test_retry_after_completion(self):
+        session = UploadSession.objects.create(
+            owner=self.user, name='video.mp4', size=10, part_size=1024 ** 3, upload_id='x'
+        )
+        url = reverse('upload-session-complete', args=[session.id])
+
+        with Stubber(aws_client._manager.s3_client) as s3:
+            # Completed in S3, then the file could not be created
+            s3.add_response('list_parts', {'Parts': [{'PartNumber': 1, 'ETag': 'etag-1', 'Size': 10}]})
+            s3.add_response('complete_multipart_upload', {})
+            s3.add_response('head_object', {'ContentLength': 10})
+            with mock.patch('files.views.register_uploaded_file', side_effect=DatabaseError):
+                with self.assertRaises(DatabaseError):
+                    self.client.post(url)
+
+            s3.add_client_error('list_parts', service_error_code='NoSuchUpload', http_status_code=404)
+            s3.add_response('head_object', {'ContentLength': 10})
+            response = self.client.get(reverse('upload-session-detail', args=[session.id]))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(response.data['completed'])
+            self.assertEqual(response.data['uploaded_parts'], [])
+
+            s3.add_client_error('list_parts', service_error_code='NoSuchUpload', http_status_code=404)
+            s3.add_response('head_object', {'ContentLength': 10})
+            response = self.client.post(url)
+            s3.assert_no_pending_responses()
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(BaseMediaFile.objects.get(name='video.mp4').storage_key, session.storage_path)
+        self.assertFalse(UploadSession.objects.filter(id=session.id).exists())
+
+    def test_complete_aborted_upload(self):
+        session = UploadSession.objects.create(
+            owner=self.user, name='video.mp4', size=10, part_size=1024 ** 3, upload_id='x'
+        )
+
+        with Stubber(aws_client._manager.s3_client) as s3:
+            s3.add_client_error('list_parts', service_error_code='NoSuchUpload', http_status_code=404)
+            s3.add_client_error('head_object', service_error_code='404', http_status_code=404)
+            response = self.client.post(reverse('upload-session-complete', args=[session.id]))
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertFalse(UploadSession.objects.filter(id=session.id).exists())
+        self.assertFalse(BaseMediaFile.objects.filter(name='video.mp4').exists())
+
+    def test_delete_completed_upload(self):
+        session = UploadSession.objects.create(
+            owner=self.user, name='video.mp4', size=10, part_size=1024 ** 3, upload_id='x'
+        )
+
+        with Stubber(aws_client._manager.s3_client) as s3:
+            s3.add_client_error('abort_multipart_upload', service_error_code='NoSuchUpload', http_status_code=404)
+            s3.add_response(
+                'delete_objects', {}, {'Bucket': settings.AWS_STORAGE_BUCKET_NAME, 'Delete': {
+                    'Objects': [{'Key': session.storage_path}], 'Quiet': True
+                }}
+            )
+            response = self.client.delete(reverse('upload-session-detail', args=[session.id]))
+            s3.assert_no_pending_responses()
+
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(UploadSession.objects.filter(id=session.id).exists())
+
+    def test_other_users_session(self):
+        other_user = User.objects.create_user(username='other', email='other@example.com', password='password')
+        session = UploadSession.objects.create(owner=other_user, name='video.mp4', size=1, part_size=1, upload_id='x')
+        response = self.client.get(reverse('upload-session-detail', args=[session.id]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
@@ -0,0 +1,130 @@
+import hashlib
+import io
+from django.conf import settings
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+from aws.s3_objects import (
+    create_multipart_upload,
+    upload_part,
+    complete_multipart_upload,
+    abort_multipart_upload,
+    upload_file
+)
+
+class S3StreamedFile:
+    """
+    Stands in for an UploadedFile whose bytes were streamed to S3. ``key`` is
+    None when the handler refused the file name and discarded the bytes.
+    ``duplicate`` is True when the content was already stored under ``key``
+    and nothing was uploaded.
+    """
+    def __init__(self, name, content_type, size, sha256, key, duplicate=False):
+        self.name = name
+        self.content_type = content_type
+        self.size = size
+        self.sha256 = sha256
+        self.key = key
+        self.duplicate = duplicate
+
+class S3StreamingUploadHandler(FileUploadHandler):
+    """
+    Streams one multipart form field straight into an S3 multipart upload as
+    the request body is parsed, without a temporary file. At most one part
+    (UPLOAD_STREAM_PART_SIZE bytes) is held in memory. The size and SHA-256
+    of the content are computed on the way through.
+
+    ``get_key`` is called with the client's file name and returns the object
+    key to upload to, or None to refuse the name and discard the bytes.
+    ``find_duplicate`` is called with the SHA-256 and size once the content
+    is complete and returns the key it is already stored under, or None;
+    duplicates are not stored again. Files that fit in one part are only
+    sent to S3 at that point, with a single PUT.
+
+    Other fields are left to the next handlers. A multipart upload the file
+    did not complete is aborted when the upload ends, including after
+    StopUpload; if reading the body raises, the caller must call
+    ``upload_interrupted`` itself, as Django does not. Uploads left open by
+    a process that died midway are aborted by ``purge_upload_sessions``.
+    """
+    def __init__(self, request, get_key, find_duplicate=None, field_name='file'):
+        super().__init__(request)
+        self.get_key = get_key
+        self.find_duplicate = find_duplicate
+        self.handled_field = field_name
+        self.part_size = max(settings.UPLOAD_STREAM_PART_SIZE, 5 * 1024 * 1024)
+        self.active = False
+        self.key = None
+        self.upload_id = None
+
+    def new_file(self, field_name, file_name, *args, **kwargs):
+        super().new_file(field_name, file_name, *args, **kwargs)
+        self.active = field_name == self.handled_field
+        if not self.active:
+            return
+
+        self.key = self.get_key(file_name)
+        self.upload_id = None
+        self.buffer = bytearray()
+        self.parts = []
+        self.sha256 = hashlib.sha256()
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        if not self.active:
+            return raw_data
+
+        self.sha256.update(raw_data)
+        if self.key is not None:
+            self.buffer += raw_data
+            if len(self.buffer) >= self.part_size:
+                # The multipart upload only starts once a full part is buffered
+                if self.upload_id is None:
+                    self.upload_id = create_multipart_upload(self.key)
+                self.flush_part()
+        return None
+
+    def flush_part(self):
+        part_number = len(self.parts) + 1
+        etag = upload_part(self.key, self.upload_id, part_number, bytes(self.buffer))
+        self.parts.append((part_number, etag))
+        self.buffer = bytearray()
+
+    def file_complete(self, file_size):
+        if not self.active:
+            return None
+        self.active = False
+
+        sha256 = self.sha256.hexdigest()
+        key = self.key
+        duplicate_key = None
+        if key is not None and self.find_duplicate is not None:
+            duplicate_key = self.find_duplicate(sha256, file_size)
+
+        if duplicate_key is not None:
+            key = duplicate_key
+            self.upload_interrupted()
+        elif self.upload_id is not None:
+            if self.buffer:
+                self.flush_part()
+            complete_multipart_upload(self.key, self.upload_id, self.parts)
+            self.upload_id = None
+        elif key is not None:
+            upload_file(io.BytesIO(self.buffer), self.key)
+        self.buffer = bytearray()
+
+        return S3StreamedFile(
+            self.file_name,
+            self.content_type,
+            file_size,
+            sha256,
+            key,
+            duplicate=duplicate_key is not None
+        )
+
+    def upload_complete(self):
+        # Also called when a handler stopped the upload with StopUpload
+        self.upload_interrupted()
+
+    def upload_interrupted(self):
+        if self.upload_id is not None:
+            abort_multipart_upload(self.key, self.upload_id)
+            self.upload_id = None
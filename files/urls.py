@@ -1,8 +1,10 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import FileViewSet, WebhookView
+from .views import FileViewSet, UploadSessionViewSet, WebhookView
 
 router = DefaultRouter()
+# Registered before the files so 'upload-sessions/' is not taken for a file id
+router.register(r'upload-sessions', UploadSessionViewSet, basename='upload-session')
 router.register(r'', FileViewSet, basename='file')
 
 urlpatterns = [
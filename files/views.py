@@ -1,151 +1,388 @@
-from django.shortcuts import get_object_or_404
-from django.db.models import Q
+import math
+import re
+from urllib.parse import urlencode
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseRedirect
+from django.urls import reverse
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import viewsets, status
-from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
+from rest_framework.decorators import action
 from rest_framework.views import APIView
 from rest_framework.exceptions import MethodNotAllowed
 from rest_framework.permissions import IsAuthenticated
-from .models import GenericFile, ImageFile, VideoFile, AudioFile, Tag, BaseMediaFile
+from .models import GenericFile, ImageFile, VideoFile, AudioFile, Tag, BaseMediaFile, UploadSession, OutboxMessage, StoredContent, StorageUsage, generate_storage_key
 from .serializers import (
     MixedFileSerializer,
+    UploadSessionSerializer,
     ImageFileSerializer,
     VideoFileSerializer,
     AudioFileSerializer
 )
-from .permissions import IsPrivateSubnet
-from aws.s3_objects import upload_file, delete_file, list_files
-from aws.sqs import enqueue_json_object
-from aws.client import bucket_name, aws_manager
+from .pagination import StandardResultsSetPagination, FileCursorPagination
+from .permissions import IsPrivateSubnet, HasWebhookSecret
+from .search import index_file
+from .upload_handlers import S3StreamingUploadHandler
+from .similarity import find_similar, find_duplicate_groups, DEFAULT_DISTANCE, MAX_DISTANCE
+from .playlists import get_playlist, is_playlist, resolve_uri, PLAYLIST_CONTENT_TYPE
+from .processing import apply_processing_results, copy_processed_file, parse_file_id, NOT_FOUND, ALREADY_PROCESSED, INVALID
+from aws.s3_objects import (
+    S3_MAX_OBJECT_SIZE,
+    S3_MAX_PARTS,
+    delete_files,
+    head_file,
+    generate_presigned_url,
+    generate_presigned_post,
+    get_part_size,
+    create_multipart_upload,
+    generate_presigned_part_urls,
+    complete_multipart_upload,
+    abort_multipart_upload,
+    list_parts
+)
+
+def validate_new_file_name(user, file_name):
+    """Return an error response if file_name cannot be used for a new file."""
+    if '/' in file_name:
+        return Response({"error": "O nome do arquivo não pode conter barras."}, status=status.HTTP_400_BAD_REQUEST)
+
+    if BaseMediaFile.objects.filter(
+        Q(name=file_name) & Q(owner=user)
+    ).exists():
+        return Response({"error": "Um arquivo com o mesmo nome já existe."}, status=status.HTTP_409_CONFLICT)
+
+    return None
+
+def is_upload_key(user, key):
+    """Whether ``key`` is a storage key generated for this user's uploads."""
+    return isinstance(key, str) and re.fullmatch(rf'users/{user.user_id}/objects/[0-9a-f]{{32}}', key) is not None
+
+def validate_upload_size(file_size):
+    """Return an error Response for sizes S3 cannot store, or None."""
+    if file_size > S3_MAX_OBJECT_SIZE:
+        return Response({"error": "O arquivo excede o tamanho máximo de 5 TB."}, status=status.HTTP_400_BAD_REQUEST)
+    return None
+
+def find_stored_content(user, content_hash, file_size):
+    """Key the user's content with this hash is already stored under, or None."""
+    return (
+        StoredContent.objects
+        .filter(owner=user, sha256=content_hash, size=file_size)
+        .values_list('storage_key', flat=True)
+        .first()
+    )
+
+def register_uploaded_file(user, file_name, file_size, storage_key, content_hash=None, duplicate=False):
+    """
+    Create the row for a file that is already in S3 and queue its
+    processing. The job goes to the outbox in the same transaction and is
+    sent to SQS by the ``dispatch_outbox`` command.
+
+    With a ``content_hash``, content the user already stored is shared: the
+    new file references the stored objects, takes the processing result of
+    the files using them and queues no job.
+
+    ``duplicate`` tells that the bytes were not uploaded because the content
+    was already stored. Returns None, and creates nothing, if that content
+    was purged in the meantime.
+    """
+    with transaction.atomic():
+        content = None
+        if content_hash is not None:
+            content, created = StoredContent.objects.select_for_update().get_or_create(
+                owner=user, sha256=content_hash, defaults={'storage_key': storage_key, 'size': file_size}
+            )
+            if created and duplicate:
+                # Nothing was uploaded and the stored copy is gone
+                transaction.set_rollback(True)
+                return None
+            if content.storage_key != storage_key:
+                # Stored again by a concurrent upload, keep the first copy
+                transaction.on_commit(lambda key=storage_key: delete_files([key]))
+                storage_key = content.storage_key
+            StoredContent.objects.filter(id=content.id).update(ref_count=F('ref_count') + 1)
+
+        source = None
+        if content is not None and not created:
+            source = (
+                BaseMediaFile.all_objects
+                .with_subclasses()
+                .filter(storage_key=storage_key, processed=True)
+                .first()
+            )
+
+        if source is not None:
+            file_instance = copy_processed_file(source.as_subclass(), name=file_name, owner=user)
+        else:
+            file_instance = GenericFile.objects.create(
+                name=file_name,
+                size=file_size,
+                owner=user,
+                processed=False,
+                storage_key=storage_key,
+                content_hash=content_hash
+            )
+        index_file(file_instance)
+        StorageUsage.objects.record([(user.user_id, file_instance.kind, 1, file_instance.size)])
 
-class StandardResultsSetPagination(PageNumberPagination):
-    page_size = 10
-    page_size_query_param = 'page_size'
-    max_page_size = 100
+        # Content that is already stored is processed, or being processed
+        if content is None or created:
+            OutboxMessage.objects.create(payload={
+                'user_id': user.user_id,
+                'file_name': file_name,
+                'file_id': file_instance.id,
+                'key': file_instance.storage_path
+            })
+
+    return file_instance
 
 class FileViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
     filter_backends = (DjangoFilterBackend,)
     pagination_class = StandardResultsSetPagination
+    # Files accepted by one bulk-delete request
+    max_bulk_delete = 1000
+
+    @property
+    def paginator(self):
+        """
+        Page-number pagination by default; keyset cursor pagination when the
+        client asks for it with ``?pagination=cursor`` or sends a ``cursor``.
+        """
+        if not hasattr(self, '_paginator'):
+            params = self.request.query_params
+            if params.get('pagination') == 'cursor' or 'cursor' in params:
+                self._paginator = FileCursorPagination()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
 
     def get_queryset(self):
-        user = self.request.user
-        types = self.request.query_params.get('type', '').split(',')
-        
-        # Filter files by ownership
-        queryset = Q(owner=user)
-        
-        # Filter by types
-        if 'image' in types:
-            queryset |= Q(id__in=ImageFile.objects.filter(owner=user).values_list('id', flat=True))
-        if 'video' in types:
-            queryset |= Q(id__in=VideoFile.objects.filter(owner=user).values_list('id', flat=True))
-        if 'audio' in types:
-            queryset |= Q(id__in=AudioFile.objects.filter(owner=user).values_list('id', flat=True))
-
-        if not types or '' in types:
-            queryset |= Q(id__in=GenericFile.objects.filter(owner=user).values_list('id', flat=True))
-            queryset |= Q(id__in=ImageFile.objects.filter(owner=user).values_list('id', flat=True))
-            queryset |= Q(id__in=VideoFile.objects.filter(owner=user).values_list('id', flat=True))
-            queryset |= Q(id__in=AudioFile.objects.filter(owner=user).values_list('id', flat=True))
-        
-        return GenericFile.objects.filter(queryset)
-
-    def list(self, request, *args, **kwargs):
         types = self.request.query_params.get('type', '').split(',')
         search = self.request.query_params.get('search', None)
-        user = self.request.user
-
-        queryset = []
-
-        # Filter by types
-        if 'image' in types:
-            queryset.extend(list(ImageFile.objects.filter(owner=user)))
-        if 'video' in types:
-            queryset.extend(list(VideoFile.objects.filter(owner=user)))
-        if 'audio' in types:
-            queryset.extend(list(AudioFile.objects.filter(owner=user)))
-        
-        # If no specific type is requested, include all
-        if not types or '' in types:
-            queryset.extend(list(GenericFile.objects.filter(owner=user)))
-            queryset.extend(list(ImageFile.objects.filter(owner=user)))
-            queryset.extend(list(VideoFile.objects.filter(owner=user)))
-            queryset.extend(list(AudioFile.objects.filter(owner=user)))
-
-        # Apply search filter
+
+        # Type filter, search, ordering and pagination all run in the database
+        queryset = (
+            BaseMediaFile.objects
+            .filter(owner=self.request.user)
+            .of_types(types)
+            .with_subclasses()
+            .prefetch_related('tags')
+        )
+
+        # Searches are ordered by relevance, newest first on ties
         if search:
-            queryset = [
-                obj for obj in queryset
-                if search.lower() in obj.name.lower() or
-                   search.lower() in (obj.description or '').lower() or
-                   any(search.lower() in tag.name.lower() for tag in obj.tags.all()) or
-                   (hasattr(obj, 'genre') and search.lower() in (obj.genre or '').lower())  # Search in genre if it exists
-            ]
+            return queryset.search(search, self.request.user).order_by('-search_rank', '-id')
+        return queryset.order_by('-id')
+
+    def get_file(self, file_id):
+        """
+        Resolve one of the user's files to its concrete subclass with a single
+        primary-key query, or return None if it does not exist.
+        """
+        try:
+            file_instance = (
+                BaseMediaFile.objects
+                .with_subclasses()
+                .prefetch_related('tags')
+                .get(id=file_id, owner=self.request.user)
+            )
+        except (BaseMediaFile.DoesNotExist, ValueError):
+            return None
+        return file_instance.as_subclass()
 
-        queryset.sort(key=lambda x: -x.id)
+    def list(self, request, *args, **kwargs):
+        queryset = self.get_queryset()
 
         # Paginate the queryset
         page = self.paginate_queryset(queryset)
         if page is not None:
-            serializer = MixedFileSerializer(page, many=True)
+            files = [file.as_subclass() for file in page]
+            serializer = MixedFileSerializer(files, many=True, context=self.get_serializer_context())
             return self.get_paginated_response(serializer.data)
 
-        serializer = MixedFileSerializer(queryset, many=True)
+        files = [file.as_subclass() for file in queryset]
+        serializer = MixedFileSerializer(files, many=True, context=self.get_serializer_context())
         return Response(serializer.data)
 
     def retrieve(self, request, *args, **kwargs):
-        file_id = kwargs.get('pk')
-        file_instance = None
-
-        for model in [GenericFile, ImageFile, VideoFile, AudioFile]:
-            try:
-                file_instance = model.objects.get(id=file_id)
-                break
-            except model.DoesNotExist:
-                continue
+        file_instance = self.get_file(kwargs.get('pk'))
 
         if file_instance is None:
             return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
 
-        if file_instance.owner.user_id != request.user.user_id:
-            return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
-
-        serializer = MixedFileSerializer(file_instance)
+        serializer = MixedFileSerializer(file_instance, context=self.get_serializer_context())
         return Response(serializer.data)
 
     def create(self, request, *args, **kwargs):
-        uploaded_file = request.FILES.get('file')
+        # The file is streamed into S3 while the body is parsed, so the name
+        # is checked before any bytes are stored
+        errors = []
+
+        def get_key(file_name):
+            error = validate_new_file_name(request.user, file_name)
+            if error is not None:
+                errors.append(error)
+                return None
+            return generate_storage_key(request.user.user_id)
+
+        def find_duplicate(content_hash, file_size):
+            return find_stored_content(request.user, content_hash, file_size)
+
+        handler = S3StreamingUploadHandler(request, get_key, find_duplicate)
+        request.upload_handlers = [handler, *request.upload_handlers]
+        try:
+            uploaded_file = request.FILES.get('file')
+        finally:
+            # Django does not tell the handlers when reading the body fails
+            # midway, e.g. when the client disconnects
+            handler.upload_interrupted()
+
+        if errors:
+            return errors[0]
 
         if not uploaded_file:
             return Response({"error": "Nenhum arquivo enviado."}, status=status.HTTP_400_BAD_REQUEST)
-        
-        if '/' in uploaded_file.name:
-            return Response({"error": "O nome do arquivo não pode conter barras."}, status=status.HTTP_400_BAD_REQUEST)
-
-        if BaseMediaFile.objects.filter(
-            Q(name=uploaded_file.name) & Q(owner=request.user)
-        ).exists():
-            return Response({"error": "Um arquivo com o mesmo nome já existe."}, status=status.HTTP_409_CONFLICT)
 
         file_name = uploaded_file.name
         file_size = uploaded_file.size
-        
-        upload_file(uploaded_file, f'users/{request.user.user_id}/files/{file_name}')
 
-        file_instance = GenericFile.objects.create(
-            name=file_name,
-            size=file_size,
-            owner=request.user,
-            processed=False
+        file_instance = register_uploaded_file(
+            request.user, file_name, file_size, uploaded_file.key, uploaded_file.sha256, uploaded_file.duplicate
         )
+        if file_instance is None:
+            return Response({"error": "O arquivo foi removido durante o envio, tente novamente."}, status=status.HTTP_409_CONFLICT)
 
-        enqueue_json_object({
-            'user_id': request.user.user_id,
-            'file_name': file_name,
-            'file_id': file_instance.id
-        })
+        serializer = MixedFileSerializer(file_instance)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=['post'], url_path='uploads')
+    def start_upload(self, request):
+        """
+        First phase of a direct-to-S3 upload. Returns a presigned POST form
+        for files up to UPLOAD_MULTIPART_THRESHOLD bytes, and a multipart
+        upload for larger files with the URLs of its first
+        UPLOAD_PART_URLS_PER_REQUEST parts; the others are signed on demand
+        by ``uploads/parts/``. The client sends the bytes to S3 and then
+        calls ``uploads/complete/`` with the returned ``key``.
+        """
+        file_name = request.data.get('name')
+        try:
+            file_size = int(request.data.get('size'))
+        except (TypeError, ValueError):
+            file_size = -1
+
+        if not file_name or file_size < 0:
+            return Response({"error": "Nome e tamanho do arquivo são obrigatórios."}, status=status.HTTP_400_BAD_REQUEST)
+
+        error = validate_upload_size(file_size) or validate_new_file_name(request.user, file_name)
+        if error is not None:
+            return error
+
+        file_path = generate_storage_key(request.user.user_id)
+        expiration = settings.UPLOAD_URL_EXPIRATION
+
+        if file_size <= settings.UPLOAD_MULTIPART_THRESHOLD:
+            post = generate_presigned_post(file_path, file_size, expiration)
+            return Response({
+                'upload_type': 'post',
+                'name': file_name,
+                'key': file_path,
+                'url': post['url'],
+                'fields': post['fields'],
+            }, status=status.HTTP_201_CREATED)
+
+        part_size = get_part_size(file_size, settings.UPLOAD_PART_SIZE)
+        part_count = math.ceil(file_size / part_size)
+        part_numbers = range(1, min(part_count, settings.UPLOAD_PART_URLS_PER_REQUEST) + 1)
+        upload_id = create_multipart_upload(file_path)
+        part_urls = generate_presigned_part_urls(file_path, upload_id, part_numbers, expiration)
+
+        return Response({
+            'upload_type': 'multipart',
+            'name': file_name,
+            'key': file_path,
+            'upload_id': upload_id,
+            'part_size': part_size,
+            'part_count': part_count,
+            'parts': [
+                {'part_number': part_number, 'url': url}
+                for part_number, url in part_urls.items()
+            ],
+        }, status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=['post'], url_path='uploads/parts')
+    def upload_parts(self, request):
+        """
+        Presigned URLs for the parts ``from`` to ``to`` (inclusive) of a
+        direct multipart upload, at most UPLOAD_PART_URLS_PER_REQUEST at once.
+        """
+        file_path = request.data.get('key')
+        upload_id = request.data.get('upload_id')
+        if not is_upload_key(request.user, file_path) or not upload_id:
+            return Response({"error": "Chave inválida."}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            first = int(request.data.get('from', 1))
+            last = int(request.data.get('to', first + settings.UPLOAD_PART_URLS_PER_REQUEST - 1))
+        except (TypeError, ValueError):
+            first = last = 0
+        last = min(last, S3_MAX_PARTS)
+        if first < 1 or last < first or last - first + 1 > settings.UPLOAD_PART_URLS_PER_REQUEST:
+            return Response({"error": "Números de parte inválidos."}, status=status.HTTP_400_BAD_REQUEST)
+
+        part_urls = generate_presigned_part_urls(
+            file_path, upload_id, range(first, last + 1), settings.UPLOAD_URL_EXPIRATION
+        )
+        return Response({'parts': [
+            {'part_number': part_number, 'url': url}
+            for part_number, url in part_urls.items()
+        ]})
+
+    @action(detail=False, methods=['post'], url_path='uploads/complete')
+    def complete_upload(self, request):
+        """
+        Second phase of a direct-to-S3 upload. Completes the multipart upload
+        if there is one, checks the object exists with a HEAD request and
+        creates the file, using the stored object's size.
+        """
+        file_name = request.data.get('name')
+        file_path = request.data.get('key')
+        upload_id = request.data.get('upload_id')
+
+        if not file_name or not file_path:
+            return Response({"error": "Nome do arquivo e chave são obrigatórios."}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Only keys handed out by uploads/ to this user, and not in use yet
+        if not is_upload_key(request.user, file_path):
+            return Response({"error": "Chave inválida."}, status=status.HTTP_400_BAD_REQUEST)
+        if BaseMediaFile.all_objects.filter(storage_key=file_path).exists():
+            return Response({"error": "Este envio já foi concluído."}, status=status.HTTP_409_CONFLICT)
+
+        error = validate_new_file_name(request.user, file_name)
+        if error is not None:
+            return error
+
+        if upload_id:
+            try:
+                parts = [(int(part['part_number']), part['etag']) for part in request.data.get('parts', [])]
+            except (TypeError, KeyError, ValueError):
+                return Response({"error": "Lista de partes inválida."}, status=status.HTTP_400_BAD_REQUEST)
+
+            try:
+                complete_multipart_upload(file_path, upload_id, parts)
+            except ClientError as e:
+                return Response({"error": e.response['Error']['Message']}, status=status.HTTP_400_BAD_REQUEST)
+
+        metadata = head_file(file_path)
+        if metadata is None:
+            return Response({"error": "O arquivo não foi enviado."}, status=status.HTTP_400_BAD_REQUEST)
+
+        file_instance = register_uploaded_file(request.user, file_name, metadata['ContentLength'], file_path)
 
         serializer = MixedFileSerializer(file_instance)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -154,22 +391,10 @@ class FileViewSet(viewsets.ModelViewSet):
         raise MethodNotAllowed("PUT method is not allowed.")
 
     def partial_update(self, request, *args, **kwargs):
-        file_id = kwargs.get('pk')
-        file_instance = None
-
-        # Try to find the file instance in any of the models
-        for model in [GenericFile, ImageFile, VideoFile, AudioFile]:
-            try:
-                file_instance = model.objects.get(id=file_id)
-                break
-            except model.DoesNotExist:
-                continue
+        file_instance = self.get_file(kwargs.get('pk'))
 
         if file_instance is None:
             return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
-        
-        if file_instance.owner.user_id != request.user.user_id:
-            return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
 
         # Check if the file is processed
         if not file_instance.processed:
@@ -183,191 +408,493 @@ class FileViewSet(viewsets.ModelViewSet):
         if not any(field in data for field in valid_fields):
             return Response({"error": "Invalid update fields."}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Allow only specific fields to be updated
-        if 'description' in data:
-            file_instance.description = data['description']
-        
-        if 'tags' in data:
-            tags = data['tags']
-            # Process tags and create them if they do not exist
-            tag_objects = []
-            for tag_name in tags:
-                tag, created = Tag.objects.get_or_create(name=tag_name)
-                tag_objects.append(tag)
-            file_instance.tags.set(tag_objects)
-        
-        if isinstance(file_instance, (VideoFile, AudioFile)) and 'genre' in data:
-            file_instance.genre = data['genre']
-
-        if 'name' in data and data['name'] != file_instance.name:
-            if BaseMediaFile.objects.filter(
-                Q(name=data['name']) & Q(owner=request.user)
-            ).exists():
-                return Response({"error": "A file with the same name already exists."}, status=status.HTTP_409_CONFLICT)
-
-            old_file_path = f'users/{request.user.user_id}/files/{file_instance.name}'
-            new_file_path = f'users/{request.user.user_id}/files/{data['name']}'
-            files = list_files(prefix=old_file_path)
-            
-            for file in files:
-                old_key = file['Key']
-                # Replace the old file path prefix with the new file path prefix
-                new_key = old_key.replace(old_file_path, new_file_path, 1)
-                
-                # Copy the old file to the new location
-                aws_manager.get_s3_client().copy_object(
-                    Bucket=bucket_name,
-                    CopySource={'Bucket': bucket_name, 'Key': old_key},
-                    Key=new_key
-                )
-                
-                # Delete the old file
-                aws_manager.get_s3_client().delete_object(
-                    Bucket=bucket_name,
-                    Key=old_key
-                )
-        
-            file_instance.name = data['name']
-        file_instance.save()
+        with transaction.atomic():
+            # Locked so a concurrent delete waits for the update, and a file
+            # trashed in the meantime is not written back
+            if BaseMediaFile.objects.select_for_update().filter(id=file_instance.id).first() is None:
+                return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+
+            # Allow only specific fields to be updated. Only the changed
+            # columns are saved, the others may have been changed meanwhile
+            changed = []
+            if 'description' in data:
+                file_instance.description = data['description']
+                changed.append('description')
+
+            if 'tags' in data:
+                tags = data['tags']
+                # Process tags and create them if they do not exist
+                tag_objects = []
+                for tag_name in tags:
+                    tag, created = Tag.objects.get_or_create(name=tag_name)
+                    tag_objects.append(tag)
+                file_instance.tags.set(tag_objects)
+
+            if isinstance(file_instance, (VideoFile, AudioFile)) and 'genre' in data:
+                file_instance.genre = data['genre']
+                changed.append('genre')
+
+            if 'name' in data and data['name'] != file_instance.name:
+                if BaseMediaFile.objects.filter(
+                    Q(name=data['name']) & Q(owner=request.user)
+                ).exists():
+                    return Response({"error": "A file with the same name already exists."}, status=status.HTTP_409_CONFLICT)
+
+                # Objects are stored under a key that does not depend on the
+                # name; files still stored under their name keep that key
+                if file_instance.storage_key is None:
+                    file_instance.storage_key = file_instance.storage_path
+                    changed.append('storage_key')
+                file_instance.name = data['name']
+                changed.append('name')
+            if changed:
+                file_instance.save(update_fields=changed)
+            index_file(file_instance)
 
         serializer = MixedFileSerializer(file_instance)
         return Response(serializer.data)
 
     def destroy(self, request, *args, **kwargs):
-        file_id = kwargs.get('pk')
-        user = self.request.user
-        file_instance = None
-
-        # Try to find the file instance in each model
-        for model in [GenericFile, ImageFile, VideoFile, AudioFile]:
-            try:
-                file_instance = model.objects.get(id=file_id, owner=user)
-                break
-            except model.DoesNotExist:
-                continue
+        file_instance = self.get_file(kwargs.get('pk'))
 
         if file_instance is None:
             return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
-        
-        if file_instance.owner.user_id != request.user.user_id:
-            return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
 
         # Check if the file is processed
         if not file_instance.processed:
             return Response({"error": "O arquivo ainda está sendo processado."}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Construct the base file path
-        base_file_path = f'users/{request.user.user_id}/files/{file_instance.name}'
+        # Moved to the trash, the objects are deleted by purge_deleted_files
+        with transaction.atomic():
+            trashed = BaseMediaFile.objects.filter(id=file_instance.id).update(deleted_at=timezone.now())
+            if trashed:
+                StorageUsage.objects.record([
+                    (file_instance.owner_id, file_instance.kind, -1, -file_instance.size)
+                ])
+
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @action(detail=False, methods=['post'], url_path='bulk-delete')
+    def bulk_delete(self, request):
+        """
+        Move many files to the trash at once. Takes ``ids`` and trashes the
+        files with one query; purge_deleted_files deletes their objects later
+        in chunked DeleteObjects calls. Files still being processed are
+        skipped.
+        """
+        file_ids = request.data.get('ids')
+        if not isinstance(file_ids, list) or not file_ids:
+            return Response({"error": "Informe os ids dos arquivos."}, status=status.HTTP_400_BAD_REQUEST)
+        if len(file_ids) > self.max_bulk_delete:
+            return Response(
+                {"error": f"No máximo {self.max_bulk_delete} arquivos por requisição."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            file_ids = {int(file_id) for file_id in file_ids}
+        except (TypeError, ValueError):
+            return Response({"error": "Ids de arquivo inválidos."}, status=status.HTTP_400_BAD_REQUEST)
+
+        files = [
+            file_instance.as_subclass()
+            for file_instance in BaseMediaFile.objects.with_subclasses().filter(owner=request.user, id__in=file_ids)
+        ]
+        deletable = [file_instance for file_instance in files if file_instance.processed]
+        deleted_ids = [file_instance.id for file_instance in deletable]
+
+        with transaction.atomic():
+            # Locked so files trashed concurrently are not counted twice
+            trashed = list(
+                BaseMediaFile.objects.select_for_update()
+                .filter(id__in=deleted_ids)
+                .values_list('owner_id', 'kind', 'size')
+            )
+            BaseMediaFile.objects.filter(id__in=deleted_ids).update(deleted_at=timezone.now())
+            StorageUsage.objects.record([(owner_id, kind, -1, -size) for owner_id, kind, size in trashed])
+
+        return Response({
+            'deleted': sorted(deleted_ids),
+            'processing': sorted(file_instance.id for file_instance in files if not file_instance.processed),
+            'not_found': sorted(file_ids - {file_instance.id for file_instance in files}),
+        })
+
+    @action(detail=True, methods=['get'])
+    def playlist(self, request, pk=None):
+        """
+        The video's HLS master playlist, or the variant playlist given by
+        ``?variant=``, with every URI rewritten to the API: variants to this
+        endpoint and other objects to ``segment``.
+        """
+        file_instance = self.get_file(pk)
+        if not isinstance(file_instance, VideoFile) or not file_instance.playlist:
+            return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        playlist_path = request.query_params.get('variant') or file_instance.playlist
+        # Variants are only served from the video's own objects
+        if resolve_uri(playlist_path, '') != playlist_path or not is_playlist(playlist_path):
+            return Response({"error": "Playlist inválida."}, status=status.HTTP_400_BAD_REQUEST)
+
+        playlist_url = request.build_absolute_uri(reverse('file-playlist', args=[file_instance.id]))
+        segment_url = request.build_absolute_uri(reverse('file-segment', args=[file_instance.id]))
+
+        def variant_url(path):
+            return f'{playlist_url}?{urlencode({"variant": path})}'
+
+        def object_url(path):
+            return f'{segment_url}?{urlencode({"path": path})}'
+
+        try:
+            content = get_playlist(file_instance, playlist_path, request.user.user_id, variant_url, object_url)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+            raise
+
+        return HttpResponse(content, content_type=PLAYLIST_CONTENT_TYPE)
+
+    @action(detail=True, methods=['get'])
+    def segment(self, request, pk=None):
+        """
+        Redirect to a presigned URL of the object given by ``?path=`` (a
+        segment, key or init section of the video's HLS streams), signed
+        when the player asks for it.
+        """
+        file_instance = self.get_file(pk)
+        if not isinstance(file_instance, VideoFile) or not file_instance.playlist:
+            return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        path = request.query_params.get('path', '')
+        # Only the video's own objects are signed
+        if resolve_uri(path, '') != path or is_playlist(path):
+            return Response({"error": "Segmento inválido."}, status=status.HTTP_400_BAD_REQUEST)
+
+        url = generate_presigned_url(f'{file_instance.storage_path}/{path}', settings.PLAYLIST_URL_EXPIRATION)
+        return HttpResponseRedirect(url)
+
+    def get_max_distance(self):
+        """The ``?distance=`` of a near-duplicate search, or None if invalid."""
+        try:
+            distance = int(self.request.query_params.get('distance', DEFAULT_DISTANCE))
+        except ValueError:
+            return None
+        return distance if 0 <= distance <= MAX_DISTANCE else None
+
+    def get_image_hashes(self):
+        """The user's image hashes as integers, by file id."""
+        return {
+            file_id: int(phash, 16)
+            for file_id, phash in ImageFile.objects
+            .filter(owner=self.request.user, phash__isnull=False)
+            .values_list('id', 'phash')
+        }
+
+    @action(detail=True, methods=['get'])
+    def similar(self, request, pk=None):
+        """
+        The user's images whose perceptual hash is at most ``?distance=``
+        bits from this image's, closest first, each with its ``distance``.
+        """
+        file_instance = self.get_file(pk)
+        if file_instance is None:
+            return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+        if not isinstance(file_instance, ImageFile) or not file_instance.phash:
+            return Response({"error": "O arquivo não é uma imagem processada."}, status=status.HTTP_400_BAD_REQUEST)
+        max_distance = self.get_max_distance()
+        if max_distance is None:
+            return Response({"error": f"A distância deve estar entre 0 e {MAX_DISTANCE}."}, status=status.HTTP_400_BAD_REQUEST)
+
+        hashes = self.get_image_hashes()
+        hashes.pop(file_instance.id, None)
+        matches = find_similar(int(file_instance.phash, 16), hashes, max_distance)
+
+        images = ImageFile.objects.prefetch_related('tags').in_bulk([file_id for file_id, _ in matches])
+        serializer = MixedFileSerializer(
+            [images[file_id] for file_id, _ in matches], many=True, context=self.get_serializer_context()
+        )
+        data = serializer.data
+        for item, (_, distance) in zip(data, matches):
+            item['distance'] = distance
+        return Response(data)
+
+    @action(detail=False, methods=['get'])
+    def duplicates(self, request):
+        """
+        Groups of the user's images with perceptual hashes at most
+        ``?distance=`` bits apart, largest groups first.
+        """
+        max_distance = self.get_max_distance()
+        if max_distance is None:
+            return Response({"error": f"A distância deve estar entre 0 e {MAX_DISTANCE}."}, status=status.HTTP_400_BAD_REQUEST)
+
+        hashes = self.get_image_hashes()
+        groups = find_duplicate_groups(hashes, max_distance)
+        names = dict(
+            ImageFile.objects
+            .filter(id__in=[file_id for group in groups for file_id in group])
+            .values_list('id', 'name')
+        )
+        return Response({"groups": [
+            [{'id': file_id, 'name': names[file_id]} for file_id in group]
+            for group in groups
+        ]})
+
+    @action(detail=True, methods=['post'])
+    def restore(self, request, pk=None):
+        """Take a file out of the trash, until it is purged."""
+        try:
+            file_instance = (
+                BaseMediaFile.all_objects
+                .with_subclasses()
+                .prefetch_related('tags')
+                .get(id=pk, owner=request.user, deleted_at__isnull=False)
+            )
+        except (BaseMediaFile.DoesNotExist, ValueError):
+            return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
 
-        # Delete the base file
-        delete_file(base_file_path)
+        # Another file may have taken the name in the meantime
+        if BaseMediaFile.objects.filter(name=file_instance.name, owner=request.user).exists():
+            return Response({"error": "Um arquivo com o mesmo nome já existe."}, status=status.HTTP_409_CONFLICT)
 
-        # Delete additional files based on file type
-        if isinstance(file_instance, ImageFile) or isinstance(file_instance, VideoFile):
-            # Delete the thumbnail
-            thumbnail_path = f'{base_file_path}/thumbnail.png'
-            delete_file(thumbnail_path)
+        with transaction.atomic():
+            restored = BaseMediaFile.all_objects.filter(
+                id=file_instance.id, deleted_at__isnull=False
+            ).update(deleted_at=None)
+            if restored:
+                StorageUsage.objects.record([(file_instance.owner_id, file_instance.kind, 1, file_instance.size)])
+        file_instance.deleted_at = None
 
-        if isinstance(file_instance, VideoFile):
-            # Delete processed video files
-            extension = file_instance.name.split('.')[-1]
-            for resolution in ['480p', '720p', '1080p']:
-                processed_path = f'{base_file_path}/processed/{resolution}.{extension}'
-                delete_file(processed_path)
+        serializer = MixedFileSerializer(file_instance.as_subclass(), context=self.get_serializer_context())
+        return Response(serializer.data)
 
-        # Delete the file instance from the database
-        file_instance.delete()
+class UploadSessionViewSet(viewsets.ViewSet):
+    """
+    Resumable uploads backed by S3 multipart uploads.
+
+    The client creates a session, asks for presigned URLs for the parts it
+    still has to send and uploads them to S3 in parallel. After a failure it
+    retrieves the session to see which parts S3 already stored and resumes
+    with the rest. Finally it completes or deletes (aborts) the session.
+    Abandoned sessions are aborted by the purge_upload_sessions command.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get_session(self, pk):
+        try:
+            return UploadSession.objects.get(id=pk, owner=self.request.user)
+        except (UploadSession.DoesNotExist, ValueError):
+            return None
+
+    def get_file_path(self, session):
+        return session.storage_path
+
+    def create(self, request):
+        file_name = request.data.get('name')
+        try:
+            file_size = int(request.data.get('size'))
+        except (TypeError, ValueError):
+            file_size = -1
+
+        if not file_name or file_size < 0:
+            return Response({"error": "Nome e tamanho do arquivo são obrigatórios."}, status=status.HTTP_400_BAD_REQUEST)
+
+        error = validate_upload_size(file_size) or validate_new_file_name(request.user, file_name)
+        if error is not None:
+            return error
+
+        if UploadSession.objects.filter(owner=request.user, name=file_name).exists():
+            return Response({"error": "Já existe um envio em andamento para este arquivo."}, status=status.HTTP_409_CONFLICT)
+
+        file_path = generate_storage_key(request.user.user_id)
+        session = UploadSession.objects.create(
+            owner=request.user,
+            name=file_name,
+            size=file_size,
+            part_size=get_part_size(file_size, settings.UPLOAD_PART_SIZE),
+            upload_id=create_multipart_upload(file_path),
+            storage_key=file_path
+        )
+
+        serializer = UploadSessionSerializer(session)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    def retrieve(self, request, pk=None):
+        session = self.get_session(pk)
+        if session is None:
+            return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        file_path = self.get_file_path(session)
+        parts = list_parts(file_path, session.upload_id)
+        # Completed by a request that failed before creating the file: no
+        # parts are left to send and completing again creates it
+        completed = parts is None and head_file(file_path) is not None
+        if parts is None and not completed:
+            session.delete()
+            return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        data = UploadSessionSerializer(session).data
+        data['completed'] = completed
+        data['uploaded_parts'] = [
+            {'part_number': part['PartNumber'], 'etag': part['ETag'], 'size': part['Size']}
+            for part in parts or []
+        ]
+        return Response(data)
+
+    def destroy(self, request, pk=None):
+        session = self.get_session(pk)
+        if session is None:
+            return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        file_path = self.get_file_path(session)
+        abort_multipart_upload(file_path, session.upload_id)
+        # An upload completed without creating its file leaves an object
+        # nothing references
+        if not BaseMediaFile.all_objects.filter(storage_key=file_path).exists():
+            delete_files([file_path])
+        session.delete()
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @action(detail=True, methods=['post'])
+    def parts(self, request, pk=None):
+        """Presigned upload URLs for the requested part numbers (all parts by default)."""
+        session = self.get_session(pk)
+        if session is None:
+            return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        part_numbers = request.data.get('part_numbers') or range(1, session.part_count + 1)
+        try:
+            part_numbers = sorted({int(part_number) for part_number in part_numbers})
+        except (TypeError, ValueError):
+            part_numbers = []
+
+        if not part_numbers or part_numbers[0] < 1 or part_numbers[-1] > session.part_count:
+            return Response({"error": "Números de parte inválidos."}, status=status.HTTP_400_BAD_REQUEST)
+
+        part_urls = generate_presigned_part_urls(
+            self.get_file_path(session),
+            session.upload_id,
+            part_numbers,
+            settings.UPLOAD_URL_EXPIRATION
+        )
+        return Response({
+            'parts': [
+                {'part_number': part_number, 'url': url}
+                for part_number, url in part_urls.items()
+            ],
+        })
+
+    @action(detail=True, methods=['post'])
+    def complete(self, request, pk=None):
+        """Complete the multipart upload from the parts S3 stored and create the file."""
+        session = self.get_session(pk)
+        if session is None:
+            return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        file_path = self.get_file_path(session)
+        parts = list_parts(file_path, session.upload_id)
+        # With no upload left, an earlier request completed it and failed
+        # before creating the file: the object is registered below
+        completed = parts is None
+
+        error = validate_new_file_name(request.user, session.name)
+        if not completed:
+            stored = {part['PartNumber'] for part in parts}
+            missing = [number for number in range(1, session.part_count + 1) if number not in stored]
+            if missing:
+                return Response({"error": "Partes faltando.", "missing_parts": missing}, status=status.HTTP_400_BAD_REQUEST)
+
+            if error is not None:
+                return error
+
+            try:
+                complete_multipart_upload(file_path, session.upload_id, [(part['PartNumber'], part['ETag']) for part in parts])
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'NoSuchUpload':
+                    return Response({"error": e.response['Error']['Message']}, status=status.HTTP_400_BAD_REQUEST)
+                completed = True
+
+        metadata = head_file(file_path)
+        if metadata is None:
+            if completed:
+                # Aborted, nothing was stored
+                session.delete()
+                return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+            return Response({"error": "O arquivo não foi enviado."}, status=status.HTTP_400_BAD_REQUEST)
+
+        if completed and error is not None:
+            # The name was taken after the upload was completed
+            delete_files([file_path])
+            session.delete()
+            return error
+
+        file_instance = register_uploaded_file(request.user, session.name, metadata['ContentLength'], file_path)
+        session.delete()
+
+        serializer = MixedFileSerializer(file_instance)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
 class WebhookView(APIView):
     # permission_classes = [IsPrivateSubnet]
-    
+    authentication_classes = []
+    permission_classes = [HasWebhookSecret]
+
     def post(self, request, *args, **kwargs):
         data = request.data
-        
-        file_id = data.get('file_id')
+
+        file_id = parse_file_id(data.get('file_id'))
         mime_type = data.get('mime_type')
         file_data = data.get('data', {})
-        
-        # Retrieve the GenericFile instance and extract its data
-        generic_file_instance = get_object_or_404(GenericFile, id=file_id)
-        file_name = generic_file_instance.name
-        file_size = generic_file_instance.size
-        file_owner = generic_file_instance.owner
-        
+
+        # The file is promoted in place: its parent row and tags are kept and
+        # only the child row changes, so it never disappears for readers
+        statuses, processed = apply_processing_results([
+            {'file_id': file_id, 'mime_type': mime_type, 'data': file_data}
+        ])
+        result = statuses[0]
+
+        if result['status'] == NOT_FOUND:
+            return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+
         # Check if the GenericFile has already been processed
-        if generic_file_instance.processed:
+        if result['status'] == ALREADY_PROCESSED:
             return Response({"error": "File has already been processed."}, status=status.HTTP_400_BAD_REQUEST)
-        
-        # Delete the GenericFile instance
-        generic_file_instance.delete()
-        
-        # Create and save media-specific instances
-        if mime_type.startswith('image/'):
-            # Create and save ImageFile instance
-            image_file = ImageFile(
-                id=file_id,  # Retain the original ID
-                name=file_name,
-                size=file_size,
-                mime_type=mime_type,
-                owner=file_owner,
-                width=file_data.get('width'),
-                height=file_data.get('height'),
-                color_depth=file_data.get('color_depth'),
-                resolution=file_data.get('resolution'),
-                exif_data=file_data.get('exif_data'),
-                processed=True
-            )
-            image_file.save()
-            serializer = ImageFileSerializer(image_file)
-        
-        elif mime_type.startswith('video/'):
-            # Create and save VideoFile instance
-            video_file = VideoFile(
-                id=file_id,  # Retain the original ID
-                name=file_name,
-                size=file_size,
-                mime_type=mime_type,
-                owner=file_owner,
-                duration=file_data.get('duration'),
-                resolution=file_data.get('resolution'),
-                frame_rate=file_data.get('frame_rate'),
-                video_codec=file_data.get('video_codec'),
-                audio_codec=file_data.get('audio_codec'),
-                bit_rate=file_data.get('bit_rate'),
-                processed=True
-            )
-            video_file.save()
-            serializer = VideoFileSerializer(video_file)
-        
-        elif mime_type.startswith('audio/'):
-            # Create and save AudioFile instance
-            audio_file = AudioFile(
-                id=file_id,  # Retain the original ID
-                name=file_name,
-                size=file_size,
-                mime_type=mime_type,
-                owner=file_owner,
-                duration=file_data.get('duration'),
-                bit_rate=file_data.get('bit_rate'),
-                sample_rate=file_data.get('sample_rate'),
-                channels=file_data.get('channels'),
-                processed=True
-            )
-            audio_file.save()
-            serializer = AudioFileSerializer(audio_file)
-        
+
+        if result['status'] == INVALID:
+            return Response({"error": result['error']}, status=status.HTTP_400_BAD_REQUEST)
+
+        file_instance = processed[file_id]
+        if isinstance(file_instance, ImageFile):
+            serializer = ImageFileSerializer(file_instance)
+        elif isinstance(file_instance, VideoFile):
+            serializer = VideoFileSerializer(file_instance)
+        elif isinstance(file_instance, AudioFile):
+            serializer = AudioFileSerializer(file_instance)
         else:
-            generic_file = GenericFile(
-                id=file_id,  # Retain the original ID
-                name=file_name,
-                size=file_size,
-                mime_type=mime_type,
-                owner=file_owner,
-                processed=True
+            serializer = MixedFileSerializer(file_instance)
+
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+class BulkWebhookView(APIView):
+    """
+    Receives a batch of processing results, as a list of the objects
+    WebhookView accepts (``file_id``, ``mime_type`` and ``data``), and
+    applies them in one transaction. Returns the status of each result;
+    results for files that are already processed are not applied again.
+    """
+    # permission_classes = [IsPrivateSubnet]
+    authentication_classes = []
+    permission_classes = [HasWebhookSecret]
+    max_batch_size = 1000
+
+    def post(self, request, *args, **kwargs):
+        results = request.data
+        if not isinstance(results, list):
+            return Response({"error": "Expected a list of results."}, status=status.HTTP_400_BAD_REQUEST)
+        if len(results) > self.max_batch_size:
+            return Response(
+                {"error": f"At most {self.max_batch_size} results per request."},
+                status=status.HTTP_400_BAD_REQUEST
             )
-            generic_file.save()
-            serializer = MixedFileSerializer(generic_file)
-        
-        return Response(serializer.data, status=status.HTTP_200_OK)
\ No newline at end of file
+
+        statuses, _ = apply_processing_results(results)
+        return Response({"results": statuses}, status=status.HTTP_200_OK)
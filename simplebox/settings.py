@@ -1,6 +1,5 @@
 import os
 from pathlib import Path
-from aws.client import bucket_name
 from datetime import timedelta
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -98,12 +97,53 @@ DATABASES = {
     }
 }
 
+# AWS clients are created on first use (see aws.client), nothing here
+# talks to AWS
+AWS_ACCOUNT_ID = os.getenv('AWS_ACCOUNT_ID')
+AWS_REGION = os.getenv('AWS_REGION')
+AWS_STORAGE_BUCKET_NAME = os.getenv('AWS_STORAGE_BUCKET_NAME')
+AWS_SQS_QUEUE_URL = os.getenv('AWS_SQS_QUEUE_URL')
+# Size of each client's HTTP connection pool, at least the number of gthread threads
+AWS_MAX_POOL_CONNECTIONS = int(os.getenv('AWS_MAX_POOL_CONNECTIONS', 10))
+AWS_PRESIGNED_URL_CACHE_SIZE = int(os.getenv('AWS_PRESIGNED_URL_CACHE_SIZE', 10000))
+# Presigned URLs are reused until this fraction of their lifetime has passed
+AWS_PRESIGNED_URL_REUSE_FRACTION = float(os.getenv('AWS_PRESIGNED_URL_REUSE_FRACTION', 0.5))
+
+# Direct-to-S3 uploads: files larger than the threshold are uploaded in
+# parts of at least UPLOAD_PART_SIZE bytes (S3 requires 5 MB minimum)
+UPLOAD_URL_EXPIRATION = int(os.getenv('UPLOAD_URL_EXPIRATION', 3600))
+UPLOAD_MULTIPART_THRESHOLD = int(os.getenv('UPLOAD_MULTIPART_THRESHOLD', 100 * 1024 * 1024))
+UPLOAD_PART_SIZE = int(os.getenv('UPLOAD_PART_SIZE', 64 * 1024 * 1024))
+# Most part URLs signed by one request, the rest are asked for page by page
+UPLOAD_PART_URLS_PER_REQUEST = int(os.getenv('UPLOAD_PART_URLS_PER_REQUEST', 100))
+# Part size used when the API streams a request body into S3, also the most
+# memory one streamed upload buffers
+UPLOAD_STREAM_PART_SIZE = int(os.getenv('UPLOAD_STREAM_PART_SIZE', 8 * 1024 * 1024))
+# Threads used to send parts when the API itself uploads a file
+UPLOAD_MAX_CONCURRENCY = int(os.getenv('UPLOAD_MAX_CONCURRENCY', 8))
+# Upload sessions and multipart uploads older than this are aborted by
+# the purge_upload_sessions command
+UPLOAD_SESSION_TTL = timedelta(hours=int(os.getenv('UPLOAD_SESSION_TTL_HOURS', 24)))
+
+# Served HLS playlists point to the API, which redirects each segment to a
+# URL valid for this long, and are cached this long; see files.playlists
+PLAYLIST_URL_EXPIRATION = int(os.getenv('PLAYLIST_URL_EXPIRATION', 15 * 60))
+PLAYLIST_CACHE_TIMEOUT = int(os.getenv('PLAYLIST_CACHE_TIMEOUT', 3600))
+
+# Deleted files stay in the trash, and can be restored, for this long before
+# the purge_deleted_files command removes them and their objects
+FILE_TRASH_RETENTION = timedelta(days=int(os.getenv('FILE_TRASH_RETENTION_DAYS', 30)))
+
+# Shared secret the processing fleet sends in the X-Webhook-Secret header,
+# webhooks are refused while it is not set
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+
 if os.getenv("TEST_ENV") != None:
     DATABASES['default'] = {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
     }
-    bucket_name = 'test'
+    AWS_STORAGE_BUCKET_NAME = 'test'
 
 AUTH_PASSWORD_VALIDATORS = [
     # {
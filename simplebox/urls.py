@@ -1,6 +1,6 @@
 from django.urls import path, include
 from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView
-from files.views import WebhookView
+from files.views import WebhookView, BulkWebhookView
 
 urlpatterns = [
     path("api/user/", include('user.urls')),
@@ -10,4 +10,5 @@ urlpatterns = [
     path('api/schema/', SpectacularAPIView.as_view(), name='schema'),
     path('api/docs/', SpectacularSwaggerView.as_view(url_name='schema'), name='docs'),
     path('api/webhook/', WebhookView.as_view(), name='webhook'),
+    path('api/webhook/bulk/', BulkWebhookView.as_view(), name='webhook-bulk'),
 ]
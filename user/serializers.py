@@ -1,11 +1,15 @@
 from rest_framework import serializers
 from user.models import User
 from user.validators import validate_image
+from files.models import StorageUsage
+from files.serializers import StorageUsageSerializer
 
 from dj_rest_auth.serializers import LoginSerializer
 from dj_rest_auth.registration.serializers import RegisterSerializer
 
 class UserSerializer(serializers.ModelSerializer):
+    storage_usage = serializers.SerializerMethodField()
+
     class Meta:
         model = User
         fields = (
@@ -15,9 +19,15 @@ class UserSerializer(serializers.ModelSerializer):
             'email',
             'profile_picture',
             'date_joined',
-            'description'
+            'description',
+            'storage_usage'
         )
 
+    def get_storage_usage(self, user):
+        # Users without files have no row yet
+        usage = StorageUsage.objects.filter(user=user).first() or StorageUsage(user=user)
+        return StorageUsageSerializer(usage).data
+
 class CustomRegisterSerializer(RegisterSerializer):
     full_name = serializers.CharField(required=True)
 
@@ -15,6 +15,8 @@ class UserViewTests(APITestCase):
         response = self.client.get(self.url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data['username'], 'testuser')
+        self.assertEqual(response.data['storage_usage']['files'], 0)
+        self.assertEqual(response.data['storage_usage']['kinds']['image'], {'files': 0, 'bytes': 0})
 
     def test_patch_user(self):
         data = {'full_name': 'NewFullName'}